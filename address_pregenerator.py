@@ -0,0 +1,83 @@
+from custody_service.configs import get_async_zellular
+from custody_service.chain_utils import solana_chain_utils
+from custody_service.custom_types import ZellularTx
+from custody_service.utils import get_env_or_error, generate_agent_id
+from custody_service import database
+import asyncio
+import json
+import os
+
+
+# Keeps the next POOL_SIZE deposit addresses of every (agent, account, chain)
+# derived in the pda cache, so createDepositAddressRange serves them from
+# the cache and only the zellular registration is left on its critical path.
+POOL_SIZE = int(os.getenv("ADDRESS_POOL_SIZE", "10000"))
+
+# chains whose address derivation is worth precomputing
+POOL_CHAINS = {
+    "SOL": (solana_chain_utils, get_env_or_error("SOLANA_ASSETMAN_ADDRESS")),
+}
+
+
+def refill(key, next_user: int, ready: dict):
+    agent, account, chain = key
+    start = max(next_user, ready.get(key, 0))
+    end = next_user + POOL_SIZE
+    if start >= end:
+        return
+    chain_utils, assetman = POOL_CHAINS[chain]
+    chain_utils.get_deposit_addresses(assetman, agent, account, range(start, end))
+    ready[key] = end
+
+
+def tx_pool_keys(index: int, i: int, tx: ZellularTx):
+    """ yields the (key, next user) pairs a tx moves """
+    match tx["type"]:
+        case "AgentRegister":
+            # new agents start at user 0 of account 0
+            agent = generate_agent_id(tx["data"]["signers"], f"{index}-{i}")
+            for chain in POOL_CHAINS:
+                yield (agent, 0, chain), 0
+        case "CreateDepositAddress":
+            data = tx["data"]
+            if data["chain"] in POOL_CHAINS:
+                yield (data["agent"], data["account"], data["chain"]), data["user"] + 1
+
+
+async def run_pregenerator():
+    zellular = get_async_zellular("custody_service_app")
+    # read the observer's cursor first: the deposit addresses reflect at least
+    # the batches it covers, the log is followed from there so no
+    # registration is missed
+    cursor = database.get_cursor(database.ZELLULAR_CURSOR_ID)
+    # the cursor's batch may be partially applied, follow from before it
+    after = cursor[0] - 1 if cursor is not None else 0
+
+    next_users = {
+        key: user for key, user in database.get_next_deposit_users().items()
+        if key[2] in POOL_CHAINS
+    }
+    ready = {}
+    print(f"pre-generating {POOL_SIZE} addresses for {len(next_users)} (agent, account, chain) pools ...")
+    for key, next_user in next_users.items():
+        await asyncio.to_thread(refill, key, next_user, ready)
+
+    async for batch, index in zellular.batches(after=after):
+        changed = set()
+        for i, tx in enumerate(json.loads(batch)):
+            try:
+                for key, next_user in tx_pool_keys(index, i, tx):
+                    if next_user >= next_users.get(key, 0):
+                        next_users[key] = next_user
+                        changed.add(key)
+            except Exception as e:
+                print(f"Zellular tx {index}-{i} skipped:", str(e))
+        for key in changed:
+            await asyncio.to_thread(refill, key, next_users[key], ready)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_pregenerator())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,122 @@
+"""
+Micro-benchmark of solana_chain_observer.get_block_transfers on synthetic
+mainnet-sized blocks against a large deposit address index.
+
+    python -m benchmarks.block_transfers [watched addresses] [blocks]
+"""
+import os
+os.environ.setdefault("SERVER_IP", "127.0.0.1")
+
+from custody_service.chain_utils.solana_chain_observer import AddressIndex, get_block_transfers
+from solders.pubkey import Pubkey
+import asyncio
+import random
+import sys
+import time
+
+
+# a busy mainnet block: ~1500 txs, a dozen static keys each, a share of v0
+# txs loading more keys from lookup tables, and a pool of hot accounts
+# (programs, sysvars, popular pools) shared by most txs
+TXS_PER_BLOCK = 1500
+STATIC_KEYS = 12
+V0_SHARE = 0.3
+LOADED_WRITABLE = 8
+LOADED_READONLY = 4
+HOT_ACCOUNTS = 300
+DEPOSITS_PER_BLOCK = 20
+LEGACY_WATCHED = 1_000
+
+
+def random_address():
+    return str(Pubkey(os.urandom(32)))
+
+
+def build_index(count: int):
+    index = AddressIndex()
+    # one shared owner keeps the benchmark's memory to the index keys
+    owner = {"agent": "0x00", "account": 0, "user": 0}
+    for _ in range(count):
+        index.owners[os.urandom(32)] = owner
+    return index
+
+
+def watched_sample(index: AddressIndex, count: int):
+    return [str(Pubkey(raw)) for raw in random.sample(list(index.owners.keys()), count)]
+
+
+def build_block(hot: list[str], deposit_addresses: list[str]):
+    deposit_txs = set(random.sample(range(TXS_PER_BLOCK), len(deposit_addresses)))
+    deposits = iter(deposit_addresses)
+    transactions = []
+    for t in range(TXS_PER_BLOCK):
+        keys = [random_address() for _ in range(STATIC_KEYS // 2)] + random.sample(hot, STATIC_KEYS // 2)
+        meta = {}
+        key_count = len(keys)
+        if random.random() < V0_SHARE:
+            writable = [random_address() for _ in range(LOADED_WRITABLE)]
+            readonly = random.sample(hot, LOADED_READONLY)
+            meta["loadedAddresses"] = {"writable": writable, "readonly": readonly}
+            key_count += LOADED_WRITABLE + LOADED_READONLY
+        if t in deposit_txs:
+            keys[1] = next(deposits)
+        meta["preBalances"] = [1_000_000] * key_count
+        meta["postBalances"] = [1_000_000] * key_count
+        meta["postBalances"][1] += 5_000_000
+        transactions.append({
+            "meta": meta,
+            "transaction": {
+                "signatures": [random_address()],
+                "message": {"accountKeys": keys},
+            },
+        })
+    return {"transactions": transactions}
+
+
+def legacy_block_transfers(block, watching_addrs: list[str]):
+    """ the previous per-watched-address scan, for comparison """
+    transfers = []
+    for tx in block["transactions"]:
+        accounts = tx["transaction"]["message"]["accountKeys"]
+        for target_address in watching_addrs:
+            if target_address in accounts:
+                index = accounts.index(target_address)
+                if tx["meta"]["postBalances"][index] - tx["meta"]["preBalances"][index] > 0:
+                    transfers.append(target_address)
+    return transfers
+
+
+def main():
+    watched = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    block_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    print(f"indexing {watched} watched addresses ...")
+    index = build_index(watched)
+    hot = [random_address() for _ in range(HOT_ACCOUNTS)]
+    blocks = [build_block(hot, watched_sample(index, DEPOSITS_PER_BLOCK)) for _ in range(block_count)]
+
+    async def run_blocks():
+        # one event loop for every block, only the calls are timed
+        found = 0
+        elapsed = 0
+        for block in blocks:
+            start = time.perf_counter()
+            transfers = await get_block_transfers(block, index)
+            elapsed += time.perf_counter() - start
+            found += len(transfers["sol_transfers"])
+        return found, elapsed
+
+    found, elapsed = asyncio.run(run_blocks())
+    elapsed /= block_count
+    print(f"get_block_transfers: {elapsed * 1000:.2f} ms/block, {found} of {DEPOSITS_PER_BLOCK * block_count} deposits found")
+
+    legacy_watched = watched_sample(index, LEGACY_WATCHED)
+    start = time.perf_counter()
+    legacy_block_transfers(blocks[0], legacy_watched)
+    legacy = time.perf_counter() - start
+    print(f"legacy scan: {legacy * 1000:.2f} ms/block with {LEGACY_WATCHED} watched addresses, "
+          f"~{legacy * watched / LEGACY_WATCHED:.1f} s/block extrapolated to {watched}")
+
+
+if __name__ == "__main__":
+    main()
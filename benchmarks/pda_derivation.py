@@ -0,0 +1,57 @@
+"""
+Runs get_deposit_addresses through the process pool path and checks it
+against in-process derivation, timing both. Exits non-zero if they differ.
+
+    python -m benchmarks.pda_derivation [users] [workers]
+"""
+import os
+import sys
+import tempfile
+os.environ.setdefault("SERVER_IP", "127.0.0.1")
+os.environ["PDA_WORKERS"] = sys.argv[2] if len(sys.argv) > 2 else "4"
+
+from custody_service.chain_utils import solana_chain_utils
+from custody_service.chain_utils.pda_cache import PdaCache
+from custody_service.solana_pda import derive_chunk
+import time
+
+
+PROGRAM_ID = "7agD1A3RRjhFR2vi3FXCMs8ou65FFC1HZa3MtvC5aHT5"
+AGENT = "0x9d3e02bff4c58845b766f21c10a5556093198e511d1f228c15f8fd319d91556e"
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    # skips the small ranges derived in process
+    user_range = range(10, 10 + max(users, solana_chain_utils.PDA_PARALLEL_MIN))
+
+    with tempfile.TemporaryDirectory() as directory:
+        # a fresh cache, so every user goes through the pool
+        solana_chain_utils.pda_cache = PdaCache(os.path.join(directory, "pda-cache.sqlite"))
+
+        start = time.perf_counter()
+        pooled = solana_chain_utils.get_deposit_addresses(PROGRAM_ID, AGENT, 0, user_range)
+        pool_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = derive_chunk(PROGRAM_ID, AGENT, 0, list(user_range))
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cached = solana_chain_utils.get_deposit_addresses(PROGRAM_ID, AGENT, 0, user_range)
+        cached_time = time.perf_counter() - start
+
+    print(f"{len(user_range)} users, {solana_chain_utils.PDA_WORKERS} workers")
+    print(f"pool: {pool_time:.2f} s, in process: {serial_time:.2f} s, cached: {cached_time:.3f} s")
+
+    expected = [{"address": expected[user][0]} for user in user_range]
+    if pooled != expected or cached != expected:
+        print("pool derivations differ from in-process ones")
+        sys.exit(1)
+    print("pool derivations match")
+    if solana_chain_utils.pda_pool is not None:
+        solana_chain_utils.pda_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
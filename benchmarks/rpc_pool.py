@@ -0,0 +1,178 @@
+"""
+Runs RpcPool against local stub JSON-RPC servers: hedging against a slow
+tail, ejection and readmission of a failing endpoint, and failover away
+from an endpoint missing a block. Exits non-zero if a scenario misbehaves.
+
+    python -m benchmarks.rpc_pool [calls]
+"""
+from custody_service.rpc_pool import RpcPool
+from custody_service.utils import RpcError
+import asyncio
+import json
+import random
+import sys
+import time
+
+
+class StubRpc:
+    """
+    Minimal HTTP/1.1 JSON-RPC server. Answers getSlot and getBlock, with a
+    chance of a slow answer, dropped connections and missing blocks.
+    """
+    def __init__(self, delay: float = 0.005, slow_share: float = 0.0, slow_delay: float = 0.5,
+                 slot: int = 1000, missing: set[int] = None, seed: int = 0):
+        self.delay = delay
+        self.slow_share = slow_share
+        self.slow_delay = slow_delay
+        self.slot = slot
+        self.missing = missing or set()
+        # its own seeded generator: the same slow answers on every run
+        self.random = random.Random(seed)
+        self.failing = False
+        self.calls = 0
+        self.url = None
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        return server
+
+    def answer(self, call):
+        if isinstance(call, list):
+            return [self.answer(c) for c in call]
+        if call["method"] == "getSlot":
+            return {"jsonrpc": "2.0", "id": call["id"], "result": self.slot}
+        slot = call["params"][0]
+        if slot in self.missing:
+            error = {"code": -32009, "message": f"Slot {slot} was skipped, or missing in long-term storage"}
+            return {"jsonrpc": "2.0", "id": call["id"], "error": error}
+        return {"jsonrpc": "2.0", "id": call["id"], "result": {"slot": slot, "transactions": []}}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = header.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                body = await reader.readexactly(length)
+                self.calls += 1
+                if self.failing:
+                    return
+                slow = self.random.random() < self.slow_share
+                await asyncio.sleep(self.slow_delay if slow else self.delay)
+                data = json.dumps(self.answer(json.loads(body))).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # dropped by the client (e.g. a lost hedge) or by the loop shutting down
+            pass
+        finally:
+            writer.close()
+
+
+def percentile(values: list[float], p: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+async def timed_calls(pool: RpcPool, calls: int):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await pool.call("getSlot", [])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def hedging(calls: int):
+    # both endpoints answer in 5 ms, but 3% of their answers take 500 ms.
+    # a hedge lands on a slow answer too 0.09% of the time, well under p99
+    stubs = [StubRpc(slow_share=0.03, seed=1), StubRpc(slow_share=0.03, seed=2)]
+    servers = [await stub.start() for stub in stubs]
+    urls = [stub.url for stub in stubs]
+    results = {}
+    for hedges in [0, 1]:
+        pool = RpcPool(urls, max_hedges=hedges, probe_interval=0.2)
+        latencies = await timed_calls(pool, calls)
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        results[hedges] = p99
+        print(f"hedges={hedges}: p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms over {calls} calls")
+    for server in servers:
+        server.close()
+    return results[1] < results[0] / 2
+
+
+async def ejection():
+    stubs = [StubRpc(), StubRpc()]
+    servers = [await stub.start() for stub in stubs]
+    pool = RpcPool([stub.url for stub in stubs], failure_threshold=3, open_seconds=60, probe_interval=0.1)
+    # the first endpoint drops every connection
+    stubs[0].failing = True
+    await timed_calls(pool, 20)
+    ejected = pool.is_open(pool.endpoints[0])
+    calls_while_open = stubs[0].calls
+    await timed_calls(pool, 20)
+    # only the probe reaches an ejected endpoint
+    probed_only = stubs[0].calls - calls_while_open <= 4
+    print(f"ejected after failures: {ejected}, only probed while ejected: {probed_only}")
+
+    stubs[0].failing = False
+    await asyncio.sleep(0.3)
+    readmitted = not pool.is_open(pool.endpoints[0])
+    print(f"readmitted once it answers again: {readmitted}")
+    for server in servers:
+        server.close()
+    return ejected and probed_only and readmitted
+
+
+async def pruned_failover():
+    # the first endpoint lacks block 5, the second one has it
+    stubs = [StubRpc(missing={5}), StubRpc()]
+    servers = [await stub.start() for stub in stubs]
+    pool = RpcPool([stub.url for stub in stubs], probe_interval=60)
+    response = await pool.call("getBlock", [5])
+    failed_over = response["result"]["slot"] == 5
+    batch = await pool.call_batch([("getBlock", [5]), ("getBlock", [6])])
+    batch_failed_over = all("result" in r for r in batch)
+    print(f"single call failed over: {failed_over}, batch failed over: {batch_failed_over}")
+
+    # when no endpoint has the block, the error is the answer
+    stubs[1].missing = {5}
+    try:
+        await pool.call("getBlock", [5])
+        missing_reported = False
+    except RpcError as e:
+        missing_reported = e.code == -32009
+    print(f"missing everywhere is reported: {missing_reported}")
+    for server in servers:
+        server.close()
+    return failed_over and batch_failed_over and missing_reported
+
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    results = {
+        "hedging": await hedging(calls),
+        "ejection": await ejection(),
+        "pruned failover": await pruned_failover(),
+    }
+    failed = [name for name, ok in results.items() if not ok]
+    if len(failed) > 0:
+        print(f"failed scenarios: {failed}")
+        sys.exit(1)
+    print("all scenarios passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+from custody_service import database
+from custody_service.custom_types import ChainId
+import sys
+
+
+SAMPLE_AGENT = "0x" + "00" * 32
+SAMPLE_ADDRESS = "0x" + "00" * 20
+
+# every query in database_api
+QUERIES = {
+    "get_user_agents": lambda: database.get_user_agents(SAMPLE_ADDRESS),
+    "get_deposit_addresses()": lambda: database.get_deposit_addresses(None, limit=100),
+    "get_deposit_addresses(agent)": lambda: database.get_deposit_addresses(SAMPLE_AGENT),
+    "get_deposit_addresses(agent, after)": lambda: database.get_deposit_addresses(SAMPLE_AGENT, "0" * 24, 100),
+    "get_deposits(agent)": lambda: database.get_deposits(SAMPLE_AGENT),
+    "get_deposits(agent, account, user)": lambda: database.get_deposits(SAMPLE_AGENT, 0, 0),
+    "get_deposits(agent, after)": lambda: database.get_deposits(SAMPLE_AGENT, after="f" * 24, limit=100),
+    "get_withdraws(agent)": lambda: database.get_withdraws(SAMPLE_AGENT),
+    "get_withdraws(agent, account, user)": lambda: database.get_withdraws(SAMPLE_AGENT, 0, 0),
+    "get_withdraws(status, target_chain)": lambda: database.get_withdraws(status="initialized", target_chain="SOL"),
+    "get_unconfirmed": lambda: database.get_unconfirmed(ChainId.Solana),
+    "get_unconfirmed(max_block)": lambda: database.get_unconfirmed(ChainId.Solana, 0),
+    "confirm_deposits": lambda: database.deposits_collection.find({"txHash": {"$in": [""]}}),
+    "find_withdraw": lambda: database.withdraws_collection.find({"id": "0x"}),
+    "get_withdraw_agents": lambda: database.withdraws_collection.find({"id": {"$in": ["0x"]}}),
+    "update_deposit(txHash)": lambda: database.deposits_collection.find({"txHash": ""}),
+    "get_dist_key": lambda: database.dist_keys_collection.find({"id": ""}),
+    "get_cursor": lambda: database.cursors_collection.find({"id": ""}),
+    "get_resume_token": lambda: database.resume_tokens_collection.find({"id": ""}),
+}
+
+
+# queries meant to walk a whole collection, an unbounded index scan is expected
+FULL_SCANS = ["get_deposit_addresses()"]
+
+# index bounds that do not narrow the scan: every value, or every string
+# (what a case-insensitive $regex turns into)
+UNBOUNDED_INTERVALS = ["[MinKey, MaxKey]", '["", {})']
+
+
+def plan_stages(plan):
+    yield plan
+    for key in ["inputStage", "queryPlan"]:
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+def is_unbounded(stage):
+    """ an index scan whose leading field is not narrowed reads the whole index """
+    bounds = stage.get("indexBounds")
+    if not bounds:
+        return False
+    leading = next(iter(bounds.values()))
+    return any(interval in UNBOUNDED_INTERVALS for interval in leading)
+
+
+def check_query_plans():
+    failed = []
+    for name, query in QUERIES.items():
+        plan = query().explain()["queryPlanner"]["winningPlan"]
+        stages = list(plan_stages(plan))
+        names = [s.get("stage") for s in stages]
+        if "COLLSCAN" in names:
+            status = "COLLSCAN"
+        elif name not in FULL_SCANS and any(s.get("stage") == "IXSCAN" and is_unbounded(s) for s in stages):
+            status = "UNBOUNDED"
+        else:
+            status = "ok"
+        print(f"{status:10} {name}: {' <- '.join(n for n in names if n)}")
+        if status != "ok":
+            failed.append(name)
+    return failed
+
+
+if __name__ == "__main__":
+    failed = check_query_plans()
+    if len(failed) > 0:
+        print(f"{len(failed)} queries run as a collection scan or an unbounded index scan: {failed}")
+        sys.exit(1)
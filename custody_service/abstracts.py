@@ -10,16 +10,23 @@ class NodeDataManager(DataManager):
     def __init__(self) -> None:
         super().__init__()
         self.__dkg_keys = {}
-        self.__nonces = {}
 
+    # nonces live in the database rather than in memory: with several server
+    # worker processes the signing request may reach another worker than the
+    # one that generated the nonce, and a used nonce must be gone everywhere.
+    # get_nonce() removes the nonce as it reads it, remove_nonce() is a no-op
+    # then.
     def set_nonce(self, nonce_public: str, nonce_private: str) -> None:
-        self.__nonces[nonce_public] = nonce_private
+        database.insert_nonce(nonce_public, nonce_private)
 
     def get_nonce(self, nonce_public: str):
-        return self.__nonces[nonce_public]
+        nonce_private = database.get_nonce(nonce_public)
+        if nonce_private is None:
+            raise KeyError(nonce_public)
+        return nonce_private
 
     def remove_nonce(self, nonce_public: str) -> None:
-        del self.__nonces[nonce_public]
+        database.remove_nonce(nonce_public)
 
     def set_key(self, key, value) -> None:
         database.insert_dist_key(id=key, key=value)
@@ -0,0 +1,113 @@
+import sqlite3, threading, time, zlib, json, os
+
+
+BLOCK_CACHE_PATH = os.getenv("BLOCK_CACHE_PATH", "./block-cache.sqlite")
+BLOCK_CACHE_MAX_BYTES = int(os.getenv("BLOCK_CACHE_MAX_BYTES", str(1 << 30)))
+
+# sqlite's default limit of host parameters in one statement
+MAX_PARAMS = 999
+# seconds between writes of the recently used marks of read entries
+TOUCH_INTERVAL = 5
+# how long writes wait for another process' lock (sqlite3's default)
+BUSY_TIMEOUT_MS = 5000
+
+
+class BlockCache:
+    """
+    Persistent tx signature -> getTransaction (json encoding) cache. The chain
+    observer fills it from the finalized blocks it fetches, the deposit
+    validators read it. Entries are zlib compressed and the least recently
+    used ones are evicted once the cache outgrows max_bytes.
+    """
+    def __init__(self, path: str = BLOCK_CACHE_PATH, max_bytes: int = BLOCK_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # reads only collect their recently used marks, written in batches
+        self._touched = {}
+        self._touched_at = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the validators read while the observer writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS txs (
+                signature TEXT NOT NULL UNIQUE,
+                slot INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS txs_used ON txs (used)")
+        self._conn.commit()
+
+    def get_many(self, signatures: list[str]) -> dict[str, dict]:
+        """ returns {signature: tx} for the cached txs """
+        found = {}
+        with self._lock:
+            for i in range(0, len(signatures), MAX_PARAMS):
+                chunk = signatures[i:i + MAX_PARAMS]
+                rows = self._conn.execute(
+                    f"SELECT signature, data FROM txs WHERE signature IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for signature, data in rows:
+                    found[signature] = data
+            now = time.time()
+            for signature in found:
+                self._touched[signature] = now
+            if time.monotonic() - self._touched_at >= TOUCH_INTERVAL:
+                self._flush_touched()
+        return {signature: json.loads(zlib.decompress(data)) for signature, data in found.items()}
+
+    def _flush_touched(self):
+        """
+        Writes the collected recently used marks. Best effort: the file is
+        shared with the observer's writes, and a busy database only costs
+        some LRU precision, so the marks are dropped then.
+        """
+        touched, self._touched = self._touched, {}
+        self._touched_at = time.monotonic()
+        if len(touched) == 0:
+            return
+        # fail right away instead of waiting for the writer's lock
+        self._conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            self._conn.executemany(
+                "UPDATE txs SET used = ? WHERE signature = ?",
+                [(used, signature) for signature, used in touched.items()]
+            )
+            self._conn.commit()
+        except sqlite3.OperationalError:
+            self._conn.rollback()
+        finally:
+            self._conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
+    def put_many(self, slot: int, txs: dict[str, dict]):
+        if len(txs) == 0:
+            return
+        now = time.time()
+        rows = [
+            (signature, slot, zlib.compress(json.dumps(tx).encode()), now)
+            for signature, tx in txs.items()
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _size(self):
+        page_size, = self._conn.execute("PRAGMA page_size").fetchone()
+        page_count, = self._conn.execute("PRAGMA page_count").fetchone()
+        freelist_count, = self._conn.execute("PRAGMA freelist_count").fetchone()
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self):
+        # freed pages are reused by later inserts, so the file stays near max_bytes
+        while self._size() > self.max_bytes:
+            count, = self._conn.execute("SELECT COUNT(*) FROM txs").fetchone()
+            if count == 0:
+                return
+            self._conn.execute(
+                "DELETE FROM txs WHERE rowid IN (SELECT rowid FROM txs ORDER BY used LIMIT ?)",
+                (max(1, count // 10),)
+            )
@@ -0,0 +1,54 @@
+import sqlite3, threading, os
+
+
+PDA_CACHE_PATH = os.getenv("PDA_CACHE_PATH", "./pda-cache.sqlite")
+
+
+class PdaCache:
+    """
+    Persistent (program, agent, account, user) -> (address, bump) cache of
+    derived deposit addresses. Derivations never change, so entries are
+    never invalidated.
+    """
+    def __init__(self, path: str = PDA_CACHE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the node's worker processes read while one of them writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pda (
+                program TEXT NOT NULL,
+                agent TEXT NOT NULL,
+                account INTEGER NOT NULL,
+                user INTEGER NOT NULL,
+                address TEXT NOT NULL,
+                bump INTEGER NOT NULL,
+                PRIMARY KEY (program, agent, account, user)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def get_many(self, program: str, agent: str, account: int, users: list[int]):
+        """ returns {user: (address, bump)} for the cached users """
+        if len(users) == 0:
+            return {}
+        wanted = set(users)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user, address, bump FROM pda "
+                "WHERE program = ? AND agent = ? AND account = ? AND user BETWEEN ? AND ?",
+                (program, agent, account, min(users), max(users))
+            ).fetchall()
+        return {user: (address, bump) for user, address, bump in rows if user in wanted}
+
+    def put_many(self, program: str, agent: str, account: int, derived: dict[int, tuple[str, int]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO pda VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (program, agent, account, user, address, bump)
+                    for user, (address, bump) in derived.items()
+                ]
+            )
+            self._conn.commit()
@@ -1,23 +1,99 @@
 from custody_service.utils import call_rpc_method, register_deposits
-from custody_service.chain_utils.solana_chain_utils import get_slot, get_block
+from custody_service.chain_utils.solana_chain_utils import get_slot, get_block, get_blocks, cache_block_transactions
+from custody_service.configs import get_async_zellular
+from custody_service import database
 from .solana_chain_utils import SOLANA_NODE_RPC
+from solders.pubkey import Pubkey
 from solana.rpc.async_api import AsyncClient
 from solana.rpc.types import TokenAccountOpts
 from typing import List, Dict, Any
 from pathlib import Path
+from collections import deque
 import asyncio, httpx, sys, json, os
 
 
 client = AsyncClient(SOLANA_NODE_RPC)
 
+# id of the last fully processed slot in the cursors collection
+CURSOR_ID = "solana_chain_observer"
+# most produced slots fetched ahead of the checkpoint while catching up
+FETCH_WINDOW = int(os.getenv("SOLANA_OBSERVER_FETCH_WINDOW", "16"))
+# slots listed per getBlocks call (the rpc allows up to 500,000)
+LIST_RANGE = 1000
 
-async def get_block_transfers(block, watching_addrs: List[str]):
+
+class AddressIndex:
+    """
+    SOL deposit address -> owner, keyed on the raw 32 byte pubkey. Loaded
+    once from the database, then kept current from the CreateDepositAddress
+    txs of the zellular log, so its upkeep does not grow with its size.
+    """
+    def __init__(self):
+        self.owners: dict[bytes, dict] = {}
+
+    def add(self, address_data):
+        if address_data["chain"] != "SOL":
+            return
+        self.owners[bytes(Pubkey.from_string(address_data["address"]))] = {
+            "agent": address_data["agent"],
+            "account": address_data["account"],
+            "user": address_data["user"],
+        }
+
+    def get(self, address: str):
+        return self.owners.get(bytes(Pubkey.from_string(address)))
+
+    def load(self):
+        """ loads the stored addresses, returns the zellular index to follow from """
+        # read the cursor first: the collection holds at least what it covers
+        cursor = database.get_cursor(database.ZELLULAR_CURSOR_ID)
+        after = None
+        while True:
+            page = list(database.get_deposit_addresses(
+                None, after, 10_000, ["chain", "agent", "account", "user", "address"]
+            ))
+            if len(page) == 0:
+                break
+            for address_data in page:
+                self.add(address_data)
+            after = page[-1]["_id"]
+        print(f"{len(self.owners)} deposit addresses loaded")
+        # the cursor's batch may be partially applied, follow from before it
+        return cursor[0] - 1 if cursor is not None else 0
+
+    async def follow(self, after: int):
+        """ follows the zellular log forever, reconnecting after the last applied batch """
+        delay = 0.5
+        while True:
+            try:
+                zellular = get_async_zellular("custody_service_app")
+                async for batch, index in zellular.batches(after=after):
+                    for tx in json.loads(batch):
+                        if tx.get("type") != "CreateDepositAddress":
+                            continue
+                        try:
+                            self.add(tx["data"])
+                        except Exception as e:
+                            print(f"Invalid deposit address in batch {index}:", str(e))
+                    after = index
+                    delay = 0.5
+            except Exception as e:
+                print(f"following deposit addresses after batch {after} failed, retrying:", str(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+
+async def get_block_transfers(block, address_index: AddressIndex):
     sol_transfers = []
     spl_transfers = []
     
     transactions = block["transactions"]
     total_received = 0
 
+    # owner (or None) of every account key seen in this block. programs and
+    # hot accounts repeat across txs and are only decoded and looked up once
+    owners = {}
+
     for tx in transactions:
         meta = tx["meta"]
         transaction = tx["transaction"]
@@ -27,47 +103,58 @@ async def get_block_transfers(block, watching_addrs: List[str]):
         
         tx_hash = transaction["signatures"][0];
 
-        # Extract accounts and balances
+        # Extract accounts and balances. balances follow the static account
+        # keys, then the writable and readonly keys loaded from lookup tables
+        # (v0 txs). readonly accounts cannot receive lamports.
         accounts = transaction["message"]["accountKeys"]
+        loaded_addresses = meta.get("loadedAddresses")
+        if loaded_addresses:
+            accounts = accounts + loaded_addresses["writable"]
         pre_balances = meta["preBalances"]
         post_balances = meta["postBalances"]
 
-        # Check if the target address is in the accounts
-        for target_address in watching_addrs:
-            if target_address in accounts:
-                index = accounts.index(target_address)
-                # Calculate balance difference
-                balance_change = post_balances[index] - pre_balances[index]
-                if balance_change > 0:
-                    sol_transfers.append({
-                        "txHash": tx_hash,
-                        "address": target_address,
-                        "change": balance_change,
-                    })
+        # Check the accounts against the watched addresses
+        for index, address in enumerate(accounts):
+            if address in owners:
+                owner = owners[address]
+            else:
+                owner = owners[address] = address_index.get(address)
+            if owner is None:
+                continue
+            # Calculate balance difference
+            balance_change = post_balances[index] - pre_balances[index]
+            if balance_change > 0:
+                sol_transfers.append({
+                    "txHash": tx_hash,
+                    "address": address,
+                    "owner": owner,
+                    "change": balance_change,
+                })
     
     return {"sol_transfers": sol_transfers, "spl_transfers": spl_transfers}
 
 
-async def process_block(block: int, deposit_addresses):
+async def process_block(block: int, address_index: AddressIndex):
     block_data = await get_block(block)
+    if block_data is None:
+        # getBlocks listed the slot, so the block exists
+        raise Exception(f"block of slot {block} not returned")
 
-    transfers = await get_block_transfers(block_data, [da["address"] for da in deposit_addresses])
+    transfers = await get_block_transfers(block_data, address_index)
 
-    address_owner_info = {
-        da["address"]: {
-            "agent": da["agent"], 
-            "account": da["account"], 
-            "user": da["user"]
-        } for da in deposit_addresses
-    }
+    # keep the deposit txs for the validators, they would fetch them again
+    try:
+        cache_block_transactions(block, block_data, {t["txHash"] for t in transfers["sol_transfers"]})
+    except Exception as e:
+        print(f"caching slot {block} txs failed:", str(e))
 
     deposits = [
         {
             "chain": "SOL",
             "block": block,
-            "agent": address_owner_info[t["address"]]["agent"],
-            "account": address_owner_info[t["address"]]["account"],
-            "user": address_owner_info[t["address"]]["user"],
+            "agent": t["owner"]["agent"],
+            "account": t["owner"]["account"],
+            "user": t["owner"]["user"],
             "txHash": t["txHash"],
             "address": t["address"],
             "deposit": {
@@ -87,27 +174,97 @@ async def call_custody_rpc(method: str, params):
     result = await call_rpc_method(CUSTODY_NODE_RPC, method, params)
     return result.get("result")
 
+async def fetch_slot(slot: int, address_index: AddressIndex):
+    """
+    process_block() retried until it succeeds. The slot is known to have a
+    block, so "skipped" or "not available" errors (e.g. from a pruned or
+    lagging node) are retried too, never taken as an empty slot.
+    """
+    delay = 0.5
+    while True:
+        try:
+            return slot, await process_block(slot, address_index)
+        except Exception as e:
+            print(f"slot {slot} failed, retrying:", str(e))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
+async def list_slots(start: int, end: int):
+    """ get_blocks() retried until it succeeds """
+    delay = 0.5
+    while True:
+        try:
+            return await get_blocks(start, end)
+        except Exception as e:
+            print(f"listing slots {start}-{end} failed, retrying:", str(e))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
 async def observe():
-    last_block = 0
+    address_index = AddressIndex()
+    after = await asyncio.to_thread(address_index.load)
+    follower = asyncio.create_task(address_index.follow(after))
+
+    checkpoint = database.get_cursor(CURSOR_ID)
+    current_block = await get_slot()
+    # resume after the checkpoint, a first run starts at the current slot
+    last_block = checkpoint[0] if checkpoint is not None else current_block - 1
+    print(f"observing from slot {last_block + 1}, {current_block - last_block} slots behind")
+
+    # produced slots up to listed_block not fetched yet, from getBlocks
+    listed_block = last_block
+    to_fetch = deque()
+    # produced slots in flight or finished, in slot order. they stay at most
+    # FETCH_WINDOW ahead of the checkpoint, so a slot that keeps failing
+    # stalls the fetching instead of piling up finished slots behind it
+    fetching = deque()
+    window = set()
+    finished = {}
     while True:
-        deposit_addresses = await call_custody_rpc("getDepositAddresses", {})
-        current_block = await get_slot();
-        if last_block > 0:
-            blocks_to_check = list(range(last_block, current_block))
-            print(f"blocks to check: {blocks_to_check}")
-            
-            tasks = [process_block(b, deposit_addresses) for b in blocks_to_check]
-            blocks_result = await asyncio.gather(*tasks)
-
-            # flatten the 2D array
-            deposits = [item for sublist in blocks_result for item in sublist]
-            
+        # a frozen index would silently miss deposits to new addresses
+        if follower.done():
+            follower.result()
+            raise Exception("Deposit address follower stopped")
+
+        if len(to_fetch) == 0 and listed_block < current_block:
+            end = min(current_block, listed_block + LIST_RANGE)
+            to_fetch.extend(await list_slots(listed_block + 1, end))
+            listed_block = end
+
+        while len(fetching) < FETCH_WINDOW and len(to_fetch) > 0:
+            slot = to_fetch.popleft()
+            fetching.append(slot)
+            window.add(asyncio.create_task(fetch_slot(slot, address_index)))
+
+        if len(window) > 0:
+            done, window = await asyncio.wait(window, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                slot, deposits = task.result()
+                finished[slot] = deposits
+
+        # the checkpoint moves up to the first unfinished produced slot,
+        # the skipped slots before it included
+        deposits = []
+        while len(fetching) > 0 and fetching[0] in finished:
+            deposits += finished.pop(fetching.popleft())
+        if len(fetching) > 0:
+            committed = fetching[0] - 1
+        elif len(to_fetch) > 0:
+            committed = to_fetch[0] - 1
+        else:
+            committed = listed_block
+        if committed > last_block:
             if len(deposits) > 0:
                 print(f"deposit detected.", json.dumps(deposits, indent=2))
-                register_deposits(deposits)
-				
-        
-        last_block = current_block
-        await asyncio.sleep(1)
+                await register_deposits(deposits)
+            database.set_cursor(CURSOR_ID, committed, 0)
+            last_block = committed
+
+        if listed_block >= current_block and len(to_fetch) == 0:
+            if len(window) == 0:
+                await asyncio.sleep(1)
+            current_block = await get_slot()
 
 __all__ = ["observe"]
@@ -1,15 +1,33 @@
-from solders.pubkey import Pubkey
-from custody_service.utils import call_rpc_method
+from custody_service.rpc_pool import RpcPool
 from custody_service.database.db_withdraws import WithdrawDoc
+from .pda_cache import PdaCache
+from .block_cache import BlockCache
+from custody_service.solana_pda import derive_deposit_address, derive_chunk, PDA_MODULE
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import hashlib, json, os
 
 
-SOLANA_NODE_RPC = os.getenv("SOLANA_NODE_RPC")
+# one or more comma separated rpc urls
+SOLANA_NODE_RPCS = [url.strip() for url in (os.getenv("SOLANA_NODE_RPC") or "").split(",") if url.strip()]
+SOLANA_NODE_RPC = SOLANA_NODE_RPCS[0] if SOLANA_NODE_RPCS else None
+
+solana_rpc = RpcPool(SOLANA_NODE_RPCS) if SOLANA_NODE_RPCS else None
+
+# bulk derivations below this size are not worth shipping to the pool
+PDA_PARALLEL_MIN = 256
+PDA_CHUNK_SIZE = 2048
+PDA_WORKERS = int(os.getenv("PDA_WORKERS", str(os.cpu_count() or 1)))
+
+pda_cache = None
+pda_pool = None
+block_cache = None
+
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 
 
 async def get_slot(commitment:str="finalized"):
-    result = await call_rpc_method(
-        SOLANA_NODE_RPC,
+    result = await solana_rpc.call(
         "getSlot",
         [
             {
@@ -21,13 +39,45 @@ async def get_slot(commitment:str="finalized"):
 
 
 async def get_transaction(tx_hash: str, encoding: str="json"):
-    result = await call_rpc_method(
-        SOLANA_NODE_RPC,
+    result = await solana_rpc.call(
         "getTransaction",
         [
             tx_hash,
             {
                 "encoding": encoding,
+                "commitment": "finalized",
+                "maxSupportedTransactionVersion": 0
+            }
+        ]
+    )
+    return result["result"]
+
+
+async def get_transactions(tx_hashes: list[str], encoding: str="json", batch_size: int=100):
+    """
+    get_transaction() for many txs in JSON-RPC batches of batch_size. Returns
+    the txs in order, with None for the ones the node did not return.
+    """
+    results = []
+    for i in range(0, len(tx_hashes), batch_size):
+        responses = await solana_rpc.call_batch(
+            [
+                ("getTransaction", [tx_hash, {"encoding": encoding, "commitment": "finalized", "maxSupportedTransactionVersion": 0}])
+                for tx_hash in tx_hashes[i:i + batch_size]
+            ]
+        )
+        results += [r.get("result") for r in responses]
+    return results
+
+
+async def get_blocks(start_slot: int, end_slot: int):
+    """ the finalized slots in [start_slot, end_slot] that produced a block """
+    result = await solana_rpc.call(
+        "getBlocks",
+        [
+            start_slot,
+            end_slot,
+            {
                 "commitment": "finalized"
             }
         ]
@@ -36,8 +86,7 @@ async def get_transaction(tx_hash: str, encoding: str="json"):
 
 
 async def get_block(slot_num: int):
-    result = await call_rpc_method(
-        SOLANA_NODE_RPC,
+    result = await solana_rpc.call(
         "getBlock",
         [
             slot_num,
@@ -52,34 +101,98 @@ async def get_block(slot_num: int):
     return result["result"]
 
 
-def get_deposit_address(program_id: str, agent: str, account: int, index: int) -> str:
-    program_id = Pubkey.from_string(program_id)
-
-    # Convert prefix seed (UTF-8 string) to bytes
-    prefix_bytes = "user-vault".encode('utf-8')
-
-    # Convert agent (u256 hex string) to bytes
-    agent_bytes = bytes.fromhex(agent[2:])  # Skip the '0x' prefix
-    if len(agent_bytes) > 32:
-        raise ValueError(
-            "agentId hex string is too long to fit into 32 bytes.")
-    elif len(agent_bytes) < 32:
-        agent_bytes = agent_bytes.rjust(32, b'\x00')
-
-    # Convert account and index to bytes (int to 8-byte representation)
-    account_bytes = account.to_bytes(8, 'big')
-    index_bytes = index.to_bytes(8, 'big')
+def _get_block_cache():
+    global block_cache
+    if block_cache is None:
+        block_cache = BlockCache()
+    return block_cache
+
+
+def cache_block_transactions(slot: int, block, tx_hashes: set[str]):
+    """ stores txs of a finalized getBlock() result as getTransaction() returns them """
+    txs = {}
+    for tx in block["transactions"]:
+        tx_hash = tx["transaction"]["signatures"][0]
+        if tx_hash in tx_hashes:
+            txs[tx_hash] = {"slot": slot, "blockTime": block.get("blockTime"), **tx}
+    _get_block_cache().put_many(slot, txs)
+
+
+async def get_cached_transactions(tx_hashes: list[str]):
+    """
+    get_transactions() in json encoding, served from the block cache where
+    the chain observer already fetched the txs.
+    """
+    try:
+        cached = _get_block_cache().get_many(tx_hashes)
+    except Exception as e:
+        # the cache only saves rpc calls, it must never fail a validation
+        print("block cache read failed, using rpc:", str(e))
+        cached = {}
+    missing = [tx_hash for tx_hash in tx_hashes if tx_hash not in cached]
+    if len(missing) > 0:
+        cached.update(zip(missing, await get_transactions(missing, "json")))
+    return [cached[tx_hash] for tx_hash in tx_hashes]
+
+
+def b58decode(data: str) -> bytes:
+    num = 0
+    for char in data:
+        num = num * 58 + B58_ALPHABET.index(char)
+    # every leading "1" is a leading zero byte
+    zeros = len(data) - len(data.lstrip("1"))
+    return b"\0" * zeros + num.to_bytes((num.bit_length() + 7) // 8, "big")
+
+
+def _get_pda_cache():
+    global pda_cache
+    if pda_cache is None:
+        pda_cache = PdaCache()
+    return pda_cache
+
+
+def _get_pda_pool():
+    global pda_pool
+    if pda_pool is None:
+        # forkserver: forking the multi-threaded rpc server process is unsafe.
+        # the fork server preloads only the derivation module instead of
+        # __main__, so it holds no database connection for workers to inherit
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([PDA_MODULE])
+        pda_pool = ProcessPoolExecutor(PDA_WORKERS, mp_context=context)
+    return pda_pool
+
+
+def get_deposit_addresses(program_id: str, agent: str, account: int, users) -> list[dict]:
+    """
+    Bulk get_deposit_address() for a list or range of users. Cached
+    derivations are read from the pda cache, the rest are derived in chunks
+    on a process pool and added to it.
+    """
+    users = list(users)
+    cache = _get_pda_cache()
+    derived = cache.get_many(program_id, agent, account, users)
+    missing = [user for user in users if user not in derived]
+
+    if len(missing) > 0:
+        if len(missing) < PDA_PARALLEL_MIN or PDA_WORKERS <= 1:
+            new = derive_chunk(program_id, agent, account, missing)
+        else:
+            chunks = [missing[i:i + PDA_CHUNK_SIZE] for i in range(0, len(missing), PDA_CHUNK_SIZE)]
+            new = {}
+            pool = _get_pda_pool()
+            futures = [pool.submit(derive_chunk, program_id, agent, account, chunk) for chunk in chunks]
+            for future in futures:
+                new.update(future.result())
+        cache.put_many(program_id, agent, account, new)
+        derived.update(new)
 
-    # Combine all the seed data into one list
-    seeds = [prefix_bytes, agent_bytes, account_bytes, index_bytes]
-    # for b in seeds:
-    #     print("-".join([f"{byte:02x}" for byte in b]))
+    return [{"address": derived[user][0]} for user in users]
 
-    # Derive the PDA using the seeds and program ID
-    (deposit_address, _) = Pubkey.find_program_address(seeds, program_id)
 
+def get_deposit_address(program_id: str, agent: str, account: int, index: int) -> str:
     # Return the PDA as a string
-    return {"address": str(deposit_address)}
+    return get_deposit_addresses(program_id, agent, account, [index])[0]
 
 
 def __hash_multiple_data(data_list):
@@ -18,6 +18,10 @@ def get_deposit_address(assetman_addr: str, agent: str, account: int, user: int)
         'address': assetman_addr,
         'memo': sha256_hash[0:30],
     }
+
+
+def get_deposit_addresses(assetman_addr: str, agent: str, account: int, users) -> list[dict]:
+    return [get_deposit_address(assetman_addr, agent, account, user) for user in users]
     
 
 def hash_withdraw(withdraw: WithdrawDoc):
@@ -2,7 +2,7 @@ from solana.rpc.api import Client
 from solana.rpc.async_api import AsyncClient
 from fastecdsa import keys, curve
 from fastecdsa.encoding.sec1 import SEC1Encoder
-from .zellular import Zellular
+from .zellular import Zellular, AsyncZellular
 from .utils import get_env_or_error
 import hashlib
 
@@ -59,6 +59,9 @@ def generate_privates_and_nodes_info(number: int = 100):
 def get_zellular(app_name: str):
 	return Zellular(app_name, "http://localhost:6379")
 
+def get_async_zellular(app_name: str):
+	return AsyncZellular(app_name, "http://localhost:6379")
+
 def new_solana_client(rpc: str = "http://localhost:8899") -> Client:
 	return Client(rpc)
 
@@ -1,4 +1,6 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, UpdateMany, ASCENDING, DESCENDING
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from custody_service.custom_types import (
     ZellularCreateDepositAddressTx,
     ZellularRegisterTx,
@@ -6,11 +8,16 @@ from custody_service.custom_types import (
     ZellularAddWithdrawTx,
     ChainId
 )
-from . import db_agents, db_deposit_addrs, db_deposits, db_withdraws, db_dist_keys
+from . import db_agents, db_deposit_addrs, db_deposits, db_withdraws, db_dist_keys, db_cursors, db_nonces, db_resume_tokens
+from .migrations import run_migrations
+from contextlib import contextmanager
 import os
 import json
 import logging, random
 
+# cursor of the zellular observer: the log position the collections reflect
+ZELLULAR_CURSOR_ID = "zellular_observer"
+
 # Create a custom logger for PyMongo
 pymongo_logger = logging.getLogger("pymongo")
 pymongo_logger.setLevel(logging.ERROR)
@@ -30,80 +37,125 @@ else:
     db_deposits.init(db, "deposits")
     db_withdraws.init(db, "withdraws")
     db_dist_keys.init(db, "dist_keys")
+    db_cursors.init(db, "cursors")
+    db_nonces.init(db, "nonces")
+    db_resume_tokens.init(db, "resume_tokens")
+    run_migrations(db)
 
     agents_collection = db["agents"]
     address_collection = db["deposit_addresses"]
     deposits_collection = db["deposits"]
     withdraws_collection = db["withdraws"]
     dist_keys_collection = db["dist_keys"]
+    cursors_collection = db["cursors"]
+    nonces_collection = db["nonces"]
+    resume_tokens_collection = db["resume_tokens"]
+
+
+def normalize_signer(address: str):
+    # EIP-55 checksums only change the letter case
+    return address.lower()
+
+
+def agent_doc(agent: ZellularRegisterTx):
+    return {**agent, "normalizedSigners": [normalize_signer(s) for s in agent["signers"]]}
 
 
-def insert_agent(agent: ZellularRegisterTx):
-    agents_collection.insert_one(agent)
+def insert_agent(agent: ZellularRegisterTx, session=None):
+    agents_collection.insert_one(agent_doc(agent), session=session)
 
 
 def get_user_agents(user_address: str):
-    # agents = agents_collection.find({"signers": {"$in": [user_address]}})
-    agents = agents_collection.find({
-        "signers": {
-            "$elemMatch": {
-                # Match the exact value (case-insensitive)
-                "$regex": f"^{user_address}$",
-                "$options": "i"  # Case-insensitive flag
-            }
-        }
-    })
-    return agents
-
-
-def insert_deposit_address(address_data: ZellularCreateDepositAddressTx):
+    return agents_collection.find({"normalizedSigners": normalize_signer(user_address)})
+
+
+def insert_deposit_address(address_data: ZellularCreateDepositAddressTx, session=None):
     doc = {**address_data, "active": True}
-    return address_collection.insert_one(doc)
+    return address_collection.insert_one(doc, session=session)
+
+
+def paginate(collection, filter: dict, after: str=None, limit: int=0, fields: list[str]=None, direction=DESCENDING):
+    """
+    Keyset pagination over _id: returns the documents following the `after`
+    _id in the given direction. `fields` restricts the returned fields, _id
+    is always included. A limit of 0 means no limit.
+    """
+    if after is not None:
+        filter = {**filter, "_id": {"$lt" if direction == DESCENDING else "$gt": ObjectId(after)}}
+    projection = {f: 1 for f in fields} if fields is not None else None
+    return collection\
+        .find(filter, projection)\
+        .sort({ '_id': direction })\
+        .limit(limit)
+
 
+def get_deposit_addresses(agent_id: str, after: str=None, limit: int=0, fields: list[str]=None):
+    agent_condition = {"agent": agent_id} if agent_id is not None else {}
+    return paginate(address_collection, agent_condition, after, limit, fields, ASCENDING)
 
-def get_deposit_addresses(agent_id: str):
-    if agent_id is not None:
-        return address_collection.find({"agent": agent_id})
-    else:
-        return address_collection.find({})
+
+def get_next_deposit_users():
+    """ {(agent, account, chain): first unassigned user} over all deposit addresses """
+    query = address_collection.aggregate([
+        {"$group": {
+            "_id": {"agent": "$agent", "account": "$account", "chain": "$chain"},
+            "last": {"$max": "$user"}
+        }}
+    ])
+    return {
+        (d["_id"]["agent"], d["_id"]["account"], d["_id"]["chain"]): d["last"] + 1
+        for d in query
+    }
 
 
-def insert_deposit(deposit: ZellularDepositTx):
-    return deposits_collection.insert_one(deposit)
+def insert_deposit(deposit: ZellularDepositTx, session=None):
+    return deposits_collection.insert_one(deposit, session=session)
 
 
-def get_deposits(agent_id: str, account: int=None, user: int=None):
+def get_deposits(agent_id: str, account: int=None, user: int=None, after: str=None, limit: int=0, fields: list[str]=None):
     account_condition = {"account": account} if account is not None else {}
     user_condition = {"user": user} if user is not None else {}
-    return deposits_collection\
-        .find({
+    return paginate(
+        deposits_collection,
+        {
             "agent": agent_id,
             **account_condition,
             **user_condition,
-        })\
-        .sort({ '_id': -1 })
+        },
+        after,
+        limit,
+        fields
+    )
 
 def find_withdraw(id: str):
     return withdraws_collection.find_one({"id": id})
 
-def get_withdraws(agent: str=None, account: int=None, user: int = None, status: str = None, target_chain: str = None):
+def get_withdraw_agents(ids: list[str]):
+    query = withdraws_collection.find({"id": {"$in": ids}}, {"id": 1, "agent": 1})
+    return {w["id"]: w["agent"] for w in query}
+
+def get_withdraws(agent: str=None, account: int=None, user: int = None, status: str = None, target_chain: str = None, after: str=None, limit: int=0, fields: list[str]=None):
     agent_condition = {"agent": agent} if agent is not None else {}
     account_condition = {"account": account} if account is not None else {}
     user_condition = {"user": user} if user is not None else {}
     status_condition = {"status": status} if status is not None else {}
     chain_condition = {"targetChain": target_chain} if target_chain is not None else {}
-    return withdraws_collection\
-        .find({
+    return paginate(
+        withdraws_collection,
+        {
             **agent_condition,
             **account_condition,
             **user_condition,
             **status_condition,
             **chain_condition
-        })\
-        .sort({ '_id': -1 })
+        },
+        after,
+        limit,
+        fields
+    )
     
 
-def approve_withdraw(id: str, avs_verifying_key: str, avs_signature: str, nonSigners: list[str]=[]):
+def approve_withdraw(id: str, avs_verifying_key: str, avs_signature: str, nonSigners: list[str]=[], session=None):
     return withdraws_collection.update_one(
         {"id": id}, 
         {"$set": {
@@ -113,22 +165,48 @@ def approve_withdraw(id: str, avs_verifying_key: str, avs_signature: str, nonSig
                 "nonSigners": nonSigners,
             },
             "status": "approved"
-        }}
+        }},
+        session=session
     );
     
 
-def set_withdraws_transfer_tx(ids: list[str], tx_hash: str):
+def set_withdraws_transfer_tx(ids: list[str], tx_hash: str, session=None):
     return withdraws_collection.update_many(
         {"id": {"$in": ids}}, 
         {"$set": {
             "txHash": tx_hash,
             "status": "transferred"
-        }}
+        }},
+        session=session
+    )
+
+
+def get_unconfirmed(chainId: ChainId, max_block: int=None):
+    block_condition = {"block": {"$lte": max_block}} if max_block is not None else {}
+    return deposits_collection.find({"chain": chainId.value, "confirmed": False, **block_condition})
+
+
+def confirm_deposits(tx_hashes: list[str]):
+    return deposits_collection.update_many(
+        {"txHash": {"$in": tx_hashes}},
+        {"$set": {"confirmed": True}}
     )
 
 
-def get_unconfirmed(chainId: ChainId):
-    return deposits_collection.find({"chain": chainId.value, "confirmed": False})
+def watch_deposits(chainId: ChainId, resume_after=None, max_await_time_ms: int=1000):
+    """
+    Change stream of the unconfirmed deposits inserted for a chain. Needs a
+    replica set, like transactions.
+    """
+    return deposits_collection.watch(
+        [{"$match": {
+            "operationType": "insert",
+            "fullDocument.chain": chainId.value,
+            "fullDocument.confirmed": False,
+        }}],
+        resume_after=resume_after,
+        max_await_time_ms=max_await_time_ms
+    )
 
 
 def update_deposit(filter, update):
@@ -138,12 +216,12 @@ def update_deposit(filter, update):
 def get_last_deposit(chain_id):
     pass
 
-def insert_new_withdraw(withdraw: ZellularAddWithdrawTx):
+def insert_new_withdraw(withdraw: ZellularAddWithdrawTx, session=None):
     doc = {
         **withdraw, 
         "status": "initialized"
     }
-    return withdraws_collection.insert_one(doc)
+    return withdraws_collection.insert_one(doc, session=session)
 
 def insert_dist_key(id: str, key):
     doc = {"id": id, "key": key}
@@ -151,4 +229,140 @@ def insert_dist_key(id: str, key):
 
 def get_dist_key(id: str):
     doc = dist_keys_collection.find_one({"id": id})
-    return doc["key"] if doc is not None else None
\ No newline at end of file
+    return doc["key"] if doc is not None else None
+
+def insert_nonce(id: str, value):
+    return nonces_collection.insert_one({"id": id, "value": value})
+
+def get_nonce(id: str):
+    # consumed atomically: a nonce must never sign twice, even when two
+    # worker processes ask for it at the same time
+    doc = nonces_collection.find_one_and_delete({"id": id})
+    return doc["value"] if doc is not None else None
+
+def remove_nonce(id: str):
+    return nonces_collection.delete_one({"id": id})
+
+
+def supports_transactions():
+    # multi-document transactions need a replica set or a sharded cluster
+    return client.topology_description.topology_type_name in ["ReplicaSetWithPrimary", "Sharded"]
+
+
+@contextmanager
+def transaction():
+    """
+    Yields a session with an open transaction, or None when the deployment
+    is a standalone server. Without transactions writes are applied one by
+    one, so callers must keep them safe to replay.
+    """
+    if not supports_transactions():
+        yield None
+        return
+    with client.start_session() as session:
+        with session.start_transaction():
+            yield session
+
+
+def get_cursor(id: str, session=None):
+    doc = cursors_collection.find_one({"id": id}, session=session)
+    return (doc["index"], doc["i"]) if doc is not None else None
+
+
+def set_cursor(id: str, index: int, i: int, session=None):
+    return cursors_collection.update_one(
+        {"id": id},
+        {"$set": {"index": index, "i": i}},
+        upsert=True,
+        session=session
+    )
+
+
+def get_resume_token(id: str):
+    doc = resume_tokens_collection.find_one({"id": id})
+    return doc["token"] if doc is not None else None
+
+
+def set_resume_token(id: str, token):
+    return resume_tokens_collection.update_one(
+        {"id": id},
+        {"$set": {"token": token}},
+        upsert=True
+    )
+
+
+# Bulk operations used to apply a whole zellular batch at once. Inserts are
+# upserts keyed on the collection's unique index so replayed or duplicated
+# txs become no-ops instead of write errors.
+
+def _insert_once_op(doc, keys: list[str]):
+    return UpdateOne({k: doc[k] for k in keys}, {"$setOnInsert": doc}, upsert=True)
+
+
+def insert_agent_op(agent: ZellularRegisterTx):
+    return "agents", _insert_once_op(agent_doc(agent), ["id"])
+
+
+def insert_deposit_address_op(address_data: ZellularCreateDepositAddressTx):
+    doc = {**address_data, "active": True}
+    return "deposit_addresses", _insert_once_op(doc, ["agent", "account", "chain", "user"])
+
+
+def insert_deposit_op(deposit: ZellularDepositTx):
+    return "deposits", _insert_once_op(deposit, ["txHash"])
+
+
+def insert_new_withdraw_op(withdraw: ZellularAddWithdrawTx):
+    doc = {
+        **withdraw, 
+        "status": "initialized"
+    }
+    return "withdraws", _insert_once_op(doc, ["id"])
+
+
+def approve_withdraw_op(id: str, avs_verifying_key: str, avs_signature: str, nonSigners: list[str]=[]):
+    return "withdraws", UpdateOne(
+        {"id": id}, 
+        {"$set": {
+            "avsSignature": {
+                "verifyingKey": avs_verifying_key, 
+                "signature": avs_signature,
+                "nonSigners": nonSigners,
+            },
+            "status": "approved"
+        }}
+    )
+
+
+def set_withdraws_transfer_tx_op(ids: list[str], tx_hash: str):
+    return "withdraws", UpdateMany(
+        {"id": {"$in": ids}}, 
+        {"$set": {
+            "txHash": tx_hash,
+            "status": "transferred"
+        }}
+    )
+
+
+def bulk_write(collection_name: str, ops: list, session=None):
+    """
+    Applies ops in order and returns (position, error message) for each
+    failed op. Without a session a failed op is skipped and the rest is
+    resubmitted. Inside a transaction the error is raised, since it has
+    already aborted the transaction.
+    """
+    collection = db[collection_name]
+    errors = []
+    offset = 0
+    while offset < len(ops):
+        try:
+            collection.bulk_write(ops[offset:], ordered=True, session=session)
+            break
+        except BulkWriteError as e:
+            if session is not None:
+                raise
+            error = e.details["writeErrors"][0]
+            position = offset + error["index"]
+            errors.append((position, error["errmsg"]))
+            offset = position + 1
+    return errors
@@ -15,6 +15,14 @@ schema = {
                 },
                 "description": "Signers must be an array of ETH address and is required"
             },
+            "normalizedSigners": {
+                "bsonType": "array",
+                "items": {
+                    "bsonType": "string",
+                    "description": "Each signer lowercased for indexed lookups"
+                },
+                "description": "normalizedSigners is derived from signers"
+            },
             "threshold": {
                 "bsonType": "int",
                 "minimum": 1,
@@ -34,4 +42,5 @@ def init(db, collection_name):
         validator=schema
     )
     collection = db[collection_name]
-    collection.create_index("id", unique=True)
\ No newline at end of file
+    collection.create_index("id", unique=True)
+    collection.create_index("normalizedSigners")
\ No newline at end of file
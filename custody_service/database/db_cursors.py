@@ -0,0 +1,33 @@
+schema = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["id", "index", "i"],
+        "properties": {
+            "id": {
+                "bsonType": "string",
+                "description": "id must be a string and is required"
+            },
+            "index": {
+                "bsonType": ["int", "long"],
+                "minimum": 0,
+                "description": "last processed position (zellular batch, chain slot, ...) and is required"
+            },
+            "i": {
+                "bsonType": ["int", "long"],
+                "description": "last processed item inside that position and is required"
+            }
+        }
+    }
+}
+
+def init(db, collection_name):
+    # return if collection exist
+    if collection_name in db.list_collection_names():
+        return;
+    
+    db.create_collection(
+        collection_name,
+        validator=schema
+    )
+    collection = db[collection_name]
+    collection.create_index("id", unique=True)
@@ -0,0 +1,27 @@
+schema = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["id", "value"],
+        "properties": {
+            "id": {
+                "bsonType": "string",
+                "description": "id (the public nonce) must be a string and is required"
+            },
+            "value": {
+                "description": "value (the private nonce) is required"
+            }
+        }
+    }
+}
+
+def init(db, collection_name):
+    # return if collection exist
+    if collection_name in db.list_collection_names():
+        return;
+    
+    db.create_collection(
+        collection_name,
+        validator=schema
+    )
+    collection = db[collection_name]
+    collection.create_index("id", unique=True)
@@ -0,0 +1,28 @@
+schema = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["id", "token"],
+        "properties": {
+            "id": {
+                "bsonType": "string",
+                "description": "id (the change stream consumer) must be a string and is required"
+            },
+            "token": {
+                "bsonType": "object",
+                "description": "token (the last processed change stream resume token) is required"
+            }
+        }
+    }
+}
+
+def init(db, collection_name):
+    # return if collection exist
+    if collection_name in db.list_collection_names():
+        return;
+    
+    db.create_collection(
+        collection_name,
+        validator=schema
+    )
+    collection = db[collection_name]
+    collection.create_index("id", unique=True)
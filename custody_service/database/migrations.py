@@ -0,0 +1,96 @@
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+
+# Versioned migrations for databases created by older releases. The init()
+# of each collection only runs for new collections, so anything added
+# later (indexes, backfills) has to be a migration. Migrations must be safe
+# to run twice: processes starting together may all run a pending one.
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+@migration(1, "compound indexes matching the database_api queries")
+def query_indexes(db):
+    # get_user_agents is served by the normalizedSigners index of migration 2
+
+    # get_deposit_addresses(agent) uses the unique (agent, account, chain, user) index
+
+    # get_deposits(agent, account, user), newest first
+    db["deposits"].create_index([("agent", ASCENDING), ("_id", DESCENDING)])
+    db["deposits"].create_index([
+        ("agent", ASCENDING),
+        ("account", ASCENDING),
+        ("user", ASCENDING),
+        ("_id", DESCENDING),
+    ])
+    # get_unconfirmed(chain)
+    db["deposits"].create_index([
+        ("chain", ASCENDING),
+        ("confirmed", ASCENDING),
+        ("block", ASCENDING),
+    ])
+
+    # get_withdraws by agent (rpc) and by status/chain (withdraw approver)
+    db["withdraws"].create_index([("agent", ASCENDING), ("_id", DESCENDING)])
+    db["withdraws"].create_index([
+        ("agent", ASCENDING),
+        ("account", ASCENDING),
+        ("user", ASCENDING),
+        ("_id", DESCENDING),
+    ])
+    db["withdraws"].create_index([
+        ("status", ASCENDING),
+        ("targetChain", ASCENDING),
+        ("_id", DESCENDING),
+    ])
+
+
+
+@migration(2, "normalized agent signers for exact getUserAgents lookups")
+def normalized_signers(db):
+    agents = db["agents"]
+    ops = []
+    for agent in agents.find({"normalizedSigners": {"$exists": False}}, {"signers": 1}):
+        normalized = [s.lower() for s in agent["signers"]]
+        ops.append(UpdateOne({"_id": agent["_id"]}, {"$set": {"normalizedSigners": normalized}}))
+        if len(ops) >= 1000:
+            agents.bulk_write(ops, ordered=False)
+            ops = []
+    if len(ops) > 0:
+        agents.bulk_write(ops, ordered=False)
+
+    agents.create_index("normalizedSigners")
+
+
+@migration(3, "agent deposit addresses in _id order for keyset pagination")
+def deposit_address_pages(db):
+    db["deposit_addresses"].create_index([("agent", ASCENDING), ("_id", ASCENDING)])
+
+def get_version(db):
+    doc = db["migrations"].find_one({"id": "schema"})
+    return doc["version"] if doc is not None else 0
+
+
+def run_migrations(db, after: int=None):
+    """
+    Runs the migrations newer than the database's version, or newer than
+    after when given, e.g. for documents restored from an older snapshot.
+    """
+    current = get_version(db) if after is None else after
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"running db migration {version}: {description}")
+        func(db)
+        db["migrations"].update_one(
+            {"id": "schema"},
+            {"$max": {"version": version}},
+            upsert=True
+        )
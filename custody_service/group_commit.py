@@ -0,0 +1,111 @@
+from concurrent.futures import Future
+from .zellular import Zellular
+import threading, logging, time, uuid
+
+
+class GroupCommitter:
+    """
+    Coalesces txs sent concurrently by many request threads into shared
+    zellular batches. A group opens with the first submit and is pushed by
+    a background thread once `window_ms` has passed or it holds `max_txs`
+    txs. A single submit larger than `max_txs` gets a batch of its own.
+    """
+    def __init__(self, zellular: Zellular, window_ms: float = 5, max_txs: int = 1000):
+        self.zellular = zellular
+        self.window = window_ms / 1000
+        self.max_txs = max_txs
+        self._cond = threading.Condition()
+        self._group = None
+        self._sealed = []
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._txs = 0
+        self._max_size = 0
+        # batch count per power of two size bucket: 1, 2, 4, ...
+        self._size_buckets = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _new_group(self):
+        return {
+            "id": uuid.uuid4().hex,
+            "txs": [],
+            "future": Future(),
+            "opened": time.monotonic(),
+        }
+
+    def _seal(self):
+        self._sealed.append(self._group)
+        self._group = None
+
+    def submit(self, txs: list):
+        """
+        Adds txs to the open group. Returns (batch id, position of the first
+        tx in the batch, future resolving to the batch index).
+        """
+        with self._cond:
+            if self._group is not None and len(self._group["txs"]) + len(txs) > self.max_txs:
+                self._seal()
+            if self._group is None:
+                self._group = self._new_group()
+            group = self._group
+            position = len(group["txs"])
+            group["txs"] += txs
+            if len(group["txs"]) >= self.max_txs:
+                self._seal()
+            self._cond.notify()
+            return group["id"], position, group["future"]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._sealed) == 0:
+                    if self._group is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._group["opened"] + self.window - time.monotonic()
+                    if remaining <= 0:
+                        self._seal()
+                    else:
+                        self._cond.wait(remaining)
+                groups, self._sealed = self._sealed, []
+            for group in groups:
+                self._push(group)
+
+    def _push(self, group):
+        try:
+            index = self.zellular.send(group["txs"], blocking=True, batch_id=group["id"])
+        except Exception as e:
+            logging.error(f"Group commit of {len(group['txs'])} txs failed: {e}")
+            group["future"].set_exception(e)
+            # async submitters only learn about it through getSubmissionStatus
+            try:
+                self.zellular.set_submission_status(group["id"], {"status": "failed", "error": str(e)})
+            except Exception as status_error:
+                logging.error(f"Recording the group commit failure failed: {status_error}")
+            return
+        group["future"].set_result(index)
+        self._record(len(group["txs"]))
+
+    def _record(self, size: int):
+        with self._stats_lock:
+            self._batches += 1
+            self._txs += size
+            self._max_size = max(self._max_size, size)
+            bucket = 1 << (size - 1).bit_length()
+            self._size_buckets[bucket] = self._size_buckets.get(bucket, 0) + 1
+            if self._batches % 1000 == 0:
+                logging.info(f"Group commit stats: {self._stats()}")
+
+    def _stats(self):
+        return {
+            "batches": self._batches,
+            "txs": self._txs,
+            "averageSize": self._txs / self._batches if self._batches else 0,
+            "maxSize": self._max_size,
+            "sizeBuckets": {str(k): v for k, v in sorted(self._size_buckets.items())},
+        }
+
+    def stats(self):
+        """ achieved batch sizes since start, for this process """
+        with self._stats_lock:
+            return self._stats()
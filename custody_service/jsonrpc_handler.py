@@ -1,21 +1,30 @@
 from flask import Blueprint, request, jsonify, abort
 from pyfrost.network.abstract import NodesInfo, DataManager
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from flask_cors import CORS
 from custody_service import database
 from custody_service.custom_types import ZellularTx
 from custody_service.utils import get_zellular
 from .zellular import Zellular
+from .group_commit import GroupCommitter
+from .token_registry import token_registry
 from .chain_utils import solana_chain_utils
 from .chain_utils import ton_chain_utils
 from .utils import get_env_or_error
 import json
 import logging
-import types, os, secrets
+import types, os, secrets, uuid
 
 
 zellular = get_zellular()
 
+# with a window > 0, txs of concurrent write calls share zellular batches
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("RPC_GROUP_COMMIT_WINDOW_MS", "0"))
+GROUP_COMMIT_MAX_TXS = int(os.getenv("RPC_GROUP_COMMIT_MAX_TXS", "1000"))
+group_committer = GroupCommitter(zellular, GROUP_COMMIT_WINDOW_MS, GROUP_COMMIT_MAX_TXS) \
+    if GROUP_COMMIT_WINDOW_MS > 0 else None
+
 
 ASSETMAN_ADDR = {
     'SOL': get_env_or_error("SOLANA_ASSETMAN_ADDRESS"),
@@ -27,6 +36,58 @@ ALL_CHIAN_UTILS = {
     'TON': ton_chain_utils
 }
 
+# server side cap on the number of documents a read method returns per list
+MAX_PAGE_SIZE = int(os.getenv("RPC_MAX_PAGE_SIZE", "1000"))
+
+# JSON-RPC batch requests: read entries run concurrently on this pool, and
+# the txs of all write entries go out as a single zellular batch
+MAX_BATCH_SIZE = int(os.getenv("RPC_MAX_BATCH_SIZE", "100"))
+batch_executor = ThreadPoolExecutor(int(os.getenv("RPC_BATCH_WORKERS", "8")))
+
+WRITE_METHODS = ["registerAgent", "createDepositAddressRange", "addWithdraw"]
+
+# longest a getSubmissionStatus long-poll may hold a request thread, in seconds
+MAX_SUBMISSION_WAIT = float(os.getenv("RPC_MAX_SUBMISSION_WAIT", "30"))
+
+# JSON-RPC 2.0 error codes
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def parse_call(data):
+    if type(data) is not dict:
+        raise RpcError(INVALID_REQUEST, "Invalid Request: request must be an object")
+    try:
+        version = data["jsonrpc"]
+        method = data["method"]
+    except KeyError as e:
+        raise RpcError(INVALID_REQUEST, f"Invalid Request: Missing key {str(e)}")
+    if version != "2.0":
+        raise RpcError(INVALID_REQUEST, "Invalid JSON-RPC version")
+    return data.get("id"), method, data.get("params") or {}
+
+
+def rpc_result(request_id, result):
+    return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+def rpc_error(request_id, e: Exception):
+    if isinstance(e, RpcError):
+        code = e.code
+    elif isinstance(e, KeyError):
+        code, e = INVALID_PARAMS, f"Invalid Request: Missing key {str(e)}"
+    else:
+        code = INTERNAL_ERROR
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": str(e)}}
+
 def request_handler(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
@@ -49,16 +110,31 @@ def request_handler(func):
 
     return wrapper
 
+def get_page_params(params: dict):
+    """
+    Reads the keyset pagination params of the list methods: `after` is the
+    _id of the last document of the previous page, `limit` is capped at
+    MAX_PAGE_SIZE and `fields` optionally restricts the returned fields.
+    """
+    limit = params.get("limit", MAX_PAGE_SIZE)
+    if type(limit) is not int or limit <= 0:
+        raise Exception("limit must be a positive integer")
+    fields = params.get("fields")
+    if fields is not None and (type(fields) is not list or not all(type(f) is str for f in fields)):
+        raise Exception("fields must be a list of field names")
+    return {
+        "after": params.get("after"),
+        "limit": min(limit, MAX_PAGE_SIZE),
+        "fields": fields,
+    }
+
+
+def serialize_docs(query):
+    return [{**d, "_id": str(d["_id"])} for d in query]
+
+
 def get_available_tokens(chain: str=None):
-    current_dir = os.path.dirname(__file__)
-    file_path = os.path.join(current_dir, "./data/available-tokens.json")
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        
-    if chain is not None:
-        data = data.get(chain, []);
-        
-    return data;
+    return token_registry.get_tokens(chain)
 
 
 
@@ -90,185 +166,24 @@ class JsonRpcHandler:
 
     @request_handler
     def jsonrpc_handler(self):
-        try:
-            data = request.get_json()
-            print("new rpc request: ", data)
-            version = data["jsonrpc"]
-            method = data["method"]
-            params = data.get("params") or {}
-            request_id = data.get("id")
-
-            if version != "2.0":
-                raise Exception("Invalid JSON-RPC version")
-
-            match method:
-                case "test":
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": solana_chain_utils.get_deposit_address("", 0, "", 0)
-                    })
-                
-                case "registerAgent":
-                    signers = params["signers"]
-                    threshold = params["threshold"]
-                    
-                    reg_tx: ZellularTx = {
-                        "type": "AgentRegister",
-                        "data": {
-                            "signers": signers,
-                            "threshold": threshold
-                        }
-                    }
+        data = request.get_json()
+        print("new rpc request: ", data)
+        if type(data) is list:
+            responses = self.handle_batch(data)
+            # a batch of only notifications gets no response body at all
+            if type(responses) is list and len(responses) == 0:
+                return ""
+            return jsonify(responses)
+        return jsonify(self.handle_call(data))
 
-                    index = zellular.send([reg_tx], blocking=True)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": index
-                    })
-                    
-                case "getUserAgents":
-                    query = database.get_user_agents(params["userAddress"])
-                    result = [{**d, "_id": str(d["_id"])} for d in query]
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": result
-                    })
-                    
-                case "getAgentData":
-                    agent = params["agent"]
-                    
-                    deposit_addrs = database.get_deposit_addresses(agent)
-                    deposits = database.get_deposits(agent)
-                    withdraws = database.get_withdraws(agent)
-                    
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": {
-                            "depositAddresses": [{**d, "_id": str(d["_id"])} for d in deposit_addrs],
-                            "deposits": [{**d, "_id": str(d["_id"])} for d in deposits],
-                            "withdraws": [{**d, "_id": str(d["_id"])} for d in withdraws],
-                        }
-                    })
-                    
-                case "createDepositAddressRange":
-                    chain = params["chain"]
-                    agent = params["agent"]
-                    account = params.get('account', 0);
-                    if chain not in ["SOL", "TON"]:
-                        raise Exception("chain not supported")
-                    [addr_from, addr_to] = params["addressRange"]
-                    print({chain, addr_from, addr_to, agent, account})
-                    
-                    txs: list[ZellularTx] = [
-                        {
-                            "type": "CreateDepositAddress",
-                            "data": {
-                                "chain": chain, 
-                                "agent": agent, 
-                                "account": account, 
-                                "user": user, 
-                                **ALL_CHIAN_UTILS[chain].get_deposit_address(
-                                    ASSETMAN_ADDR[chain],
-                                    agent,
-                                    account,
-                                    user
-                                )
-                            }
-                        }
-                        for user in range(addr_from, addr_to)
-                    ]
-                    index = zellular.send(txs, blocking=True)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": index
-                    })
-                    
-                case "getDepositAddresses":
-                    agent = params["agent"] if "agent" in params else None
-                    
-                    query = database.get_deposit_addresses(agent)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": [{**d, "_id": str(d["_id"])} for d in query]
-                    })
-                    
-                case "getAvailableTokens":
-                    chain = params.get("chain")
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": get_available_tokens(chain),
-                    })
-                    
-                case "getDeposits":
-                    agent = params["agent"]
-                    account = params["account"] if "account" in params else None
-                    user = params["user"] if "user" in params else None
-                    
-                    query = database.get_deposits(agent, account, user)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": [{**d, "_id": str(d["_id"])} for d in query]
-                    })
-                    
-                case "getWithdraws":
-                    agent = params["agent"]
-                    account = params["account"] if "account" in params else None
-                    user = params["user"] if "user" in params else None
-                    
-                    if agent is None:
-                        raise Exception("agent id cannot be null")
-                    
-                    query = database.get_withdraws(agent, account, user)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": [{**d, "_id": str(d["_id"])} for d in query]
-                    })
-                    
-                case "addWithdraw":
-                    agent = params["agent"]
-                    signatures = params["signatures"]
-                    token_symbol = params["token"]
-                    target_chain = params["targetChain"]
-                    amount = params["amount"]
-                    to_address = params["toAddress"]
-                    
-                    available_tokens = get_available_tokens(target_chain)
-                    token_info = next((item for item in available_tokens if item["symbol"] == token_symbol), None)
-                    
-                    if token_info is None:
-                        raise Exception('Withdrawing token info not found')
-                    
-                    add_withdraw_tx: ZellularTx = {
-                        "type": "AddWithdraw",
-                        "data": {
-                            "id": "0x"+secrets.token_hex(32), 
-                            "agent": agent,
-                            "signatures": signatures,
-                            "token": token_info,
-                            "targetChain": target_chain,
-                            "amount": amount,
-                            "toAddress": to_address,
-                        }
-                    }
-                    
-                    index = zellular.send([add_withdraw_tx], blocking=True)
-                    return jsonify({
-                        "jsonrpc": "2.0",
-                        "id": request_id,
-                        "result": index
-                    })
-
-                case _:
-                    raise Exception(f"Method '{method}' not found")
+    def handle_call(self, data):
+        try:
+            request_id, method, params = parse_call(data)
+            if method in WRITE_METHODS:
+                [result] = self.send_writes([(params, self.write_txs(method, params))])
+            else:
+                result = self.read(method, params)
+            return rpc_result(request_id, result)
 
         except KeyError as e:
             # If a key is missing in the request, return an error response
@@ -277,3 +192,239 @@ class JsonRpcHandler:
         except Exception as e:
             # Catch any unexpected errors and return a generic error
             raise Exception(str(e))
+
+    def handle_batch(self, calls: list):
+        """
+        Handles a JSON-RPC 2.0 batch. Every entry gets its own result or
+        error object, and notifications (entries without an id) get none.
+        """
+        if len(calls) == 0:
+            return rpc_error(None, RpcError(INVALID_REQUEST, "Invalid Request: empty batch"))
+        if len(calls) > MAX_BATCH_SIZE:
+            return rpc_error(None, RpcError(INVALID_REQUEST, f"Invalid Request: batch larger than {MAX_BATCH_SIZE}"))
+
+        responses = [None] * len(calls)
+        reads = []
+        writes = []
+        for position, data in enumerate(calls):
+            request_id = data.get("id") if type(data) is dict else None
+            try:
+                request_id, method, params = parse_call(data)
+                if method in WRITE_METHODS:
+                    writes.append((position, request_id, params, self.write_txs(method, params)))
+                else:
+                    reads.append((position, request_id, batch_executor.submit(self.read, method, params)))
+            except Exception as e:
+                responses[position] = rpc_error(request_id, e)
+
+        if len(writes) > 0:
+            try:
+                results = self.send_writes([(params, txs) for _, _, params, txs in writes])
+                for (position, request_id, _, _), result in zip(writes, results):
+                    responses[position] = rpc_result(request_id, result)
+            except Exception as e:
+                for position, request_id, _, _ in writes:
+                    responses[position] = rpc_error(request_id, e)
+
+        for position, request_id, future in reads:
+            try:
+                responses[position] = rpc_result(request_id, future.result())
+            except Exception as e:
+                responses[position] = rpc_error(request_id, e)
+
+        return [
+            response for data, response in zip(calls, responses)
+            if type(data) is not dict or "id" in data
+        ]
+
+    def send_writes(self, writes: list[tuple[dict, list[ZellularTx]]]):
+        """
+        Sends the txs of one or more write calls as a single zellular batch.
+        Returns each call's result: the batch index, or for calls made with
+        "async": true a submission id that getSubmissionStatus resolves.
+        Calls made with "withPosition": true get {"index", "position"} or
+        {"submissionId", "position"} instead, the position of the call's
+        first tx in the batch (agent ids derive from both). Other calls share
+        the batch too, through a batch request or the group committer.
+        """
+        blocking = not all(params.get("async", False) for params, _ in writes)
+        txs = []
+        positions = []
+        for _, write_txs in writes:
+            positions.append(len(txs))
+            txs += write_txs
+        if group_committer is not None:
+            batch_id, start, future = group_committer.submit(txs)
+            if not blocking:
+                # the group may not be pushed yet, tell getSubmissionStatus
+                # the id is known. a failure recorded meanwhile is kept
+                zellular.set_submission_status(batch_id, {"status": "pending"}, only_new=True)
+            index = future.result() if blocking else None
+        else:
+            start = 0
+            batch_id = uuid.uuid4().hex
+            index = zellular.send(txs, blocking=blocking, batch_id=batch_id)
+        results = []
+        for (params, _), position in zip(writes, positions):
+            if params.get("withPosition", False):
+                result = {"submissionId": batch_id} if params.get("async", False) else {"index": index}
+                result["position"] = start + position
+            else:
+                result = {"submissionId": batch_id} if params.get("async", False) else index
+            results.append(result)
+        return results
+
+    def read(self, method: str, params: dict):
+        match method:
+            case "test":
+                return solana_chain_utils.get_deposit_address("", 0, "", 0)
+                
+            case "getUserAgents":
+                query = database.get_user_agents(params["userAddress"])
+                return serialize_docs(query)
+                
+            case "getAgentData":
+                agent = params["agent"]
+                # first page of each list, the list methods return the rest
+                page = {**get_page_params(params), "after": None}
+                
+                deposit_addrs = database.get_deposit_addresses(agent, **page)
+                deposits = database.get_deposits(agent, **page)
+                withdraws = database.get_withdraws(agent, **page)
+                
+                return {
+                    "depositAddresses": serialize_docs(deposit_addrs),
+                    "deposits": serialize_docs(deposits),
+                    "withdraws": serialize_docs(withdraws),
+                }
+                
+            case "getDepositAddresses":
+                agent = params["agent"] if "agent" in params else None
+                
+                query = database.get_deposit_addresses(agent, **get_page_params(params))
+                return serialize_docs(query)
+                
+            case "getAvailableTokens":
+                chain = params.get("chain")
+                return get_available_tokens(chain)
+                
+            case "getDeposits":
+                agent = params["agent"]
+                account = params["account"] if "account" in params else None
+                user = params["user"] if "user" in params else None
+                
+                query = database.get_deposits(agent, account, user, **get_page_params(params))
+                return serialize_docs(query)
+                
+            case "getWithdraws":
+                agent = params["agent"]
+                account = params["account"] if "account" in params else None
+                user = params["user"] if "user" in params else None
+                
+                if agent is None:
+                    raise Exception("agent id cannot be null")
+                
+                query = database.get_withdraws(agent, account, user, **get_page_params(params))
+                return serialize_docs(query)
+
+            case "getGroupCommitStats":
+                if group_committer is None:
+                    raise Exception("group commit is disabled")
+                return group_committer.stats()
+
+            case "getSubmissionStatus":
+                submission_id = params["submissionId"]
+                # optional long-poll: wait up to `wait` seconds for finalization
+                wait = min(float(params.get("wait", 0)), MAX_SUBMISSION_WAIT)
+                if wait > 0:
+                    index = zellular.wait_batch_index(submission_id, wait)
+                else:
+                    index = zellular.get_batch_index(submission_id)
+                if index is not None:
+                    return {"status": "finalized", "index": index}
+                # pending or failed group commits. without group commit the
+                # id is mapped as the batch is pushed, so a missing one was
+                # never sent, is mistyped or has expired
+                status = zellular.get_submission_status(submission_id)
+                return status if status is not None else {"status": "unknown"}
+
+            case _:
+                raise RpcError(METHOD_NOT_FOUND, f"Method '{method}' not found")
+
+    def write_txs(self, method: str, params: dict) -> list[ZellularTx]:
+        """ builds the zellular txs of a write method, the caller sends them """
+        match method:
+            case "registerAgent":
+                signers = params["signers"]
+                threshold = params["threshold"]
+                
+                reg_tx: ZellularTx = {
+                    "type": "AgentRegister",
+                    "data": {
+                        "signers": signers,
+                        "threshold": threshold
+                    }
+                }
+                return [reg_tx]
+                
+            case "createDepositAddressRange":
+                chain = params["chain"]
+                agent = params["agent"]
+                account = params.get('account', 0);
+                if chain not in ["SOL", "TON"]:
+                    raise Exception("chain not supported")
+                [addr_from, addr_to] = params["addressRange"]
+                print({chain, addr_from, addr_to, agent, account})
+                
+                users = range(addr_from, addr_to)
+                addresses = ALL_CHIAN_UTILS[chain].get_deposit_addresses(
+                    ASSETMAN_ADDR[chain],
+                    agent,
+                    account,
+                    users
+                )
+                
+                txs: list[ZellularTx] = [
+                    {
+                        "type": "CreateDepositAddress",
+                        "data": {
+                            "chain": chain, 
+                            "agent": agent, 
+                            "account": account, 
+                            "user": user, 
+                            **address
+                        }
+                    }
+                    for user, address in zip(users, addresses)
+                ]
+                return txs
+                
+            case "addWithdraw":
+                agent = params["agent"]
+                signatures = params["signatures"]
+                token_symbol = params["token"]
+                target_chain = params["targetChain"]
+                amount = params["amount"]
+                to_address = params["toAddress"]
+                
+                token_info = token_registry.find_by_symbol(target_chain, token_symbol)
+                
+                if token_info is None:
+                    raise Exception('Withdrawing token info not found')
+                
+                add_withdraw_tx: ZellularTx = {
+                    "type": "AddWithdraw",
+                    "data": {
+                        "id": "0x"+secrets.token_hex(32), 
+                        "agent": agent,
+                        "signatures": signatures,
+                        "token": token_info,
+                        "targetChain": target_chain,
+                        "amount": amount,
+                        "toAddress": to_address,
+                    }
+                }
+                return [add_withdraw_tx]
+
+            case _:
+                raise RpcError(METHOD_NOT_FOUND, f"Method '{method}' not found")
@@ -0,0 +1,228 @@
+from collections import deque
+from .utils import call_rpc_method, call_rpc_batch, RpcError
+import asyncio, logging, time
+
+
+# smoothing factor of the per endpoint error rate
+ERROR_ALPHA = 0.1
+# score penalties, in seconds of latency
+ERROR_PENALTY = 1.0
+SLOT_LAG_PENALTY = 0.05
+
+# errors of an endpoint that does not have the data (pruned history, lagging
+# behind, slot cleaned up). another endpoint may have it, so these fail over
+# instead of being final answers
+UNAVAILABLE_ERRORS = [-32001, -32004, -32007, -32009, -32011, -32014, -32016]
+
+
+def is_unavailable(error):
+    return isinstance(error, RpcError) and error.code in UNAVAILABLE_ERRORS
+
+
+def has_unavailable(responses):
+    """ a batch answer where some call hit an unavailable error """
+    return isinstance(responses, list) and any(
+        isinstance(r.get("error"), dict) and r["error"].get("code") in UNAVAILABLE_ERRORS
+        for r in responses
+    )
+
+
+class Endpoint:
+    def __init__(self, url: str, samples: int = 100):
+        self.url = url
+        self.latencies = deque(maxlen=samples)
+        self.error_rate = 0.0
+        # consecutive transport failures, the circuit opens at a threshold
+        self.failures = 0
+        self.open_until = 0.0
+        self.slot = None
+
+    def latency(self, percentile: float, default: float):
+        if len(self.latencies) == 0:
+            return default
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+
+class RpcPool:
+    """
+    JSON-RPC client over several equivalent endpoints. Each call goes to the
+    healthiest endpoint, scored by median latency, error rate and slot lag.
+    A call still running after the endpoint's `hedge_percentile` latency,
+    capped at `hedge_median_factor` times its median and at `max_hedge_delay`
+    so a growing slow tail cannot push the deadline out of reach, is
+    duplicated on the next best endpoint and the first answer wins. After
+    `failure_threshold` consecutive transport failures an endpoint's circuit
+    opens for `open_seconds`; the background probe closes it again once the
+    endpoint answers. Answers with an UNAVAILABLE_ERRORS error count against
+    the endpoint's score and move on to the next endpoint; they are only
+    returned when no endpoint has the data. Only use it for read methods,
+    hedged calls may run twice.
+    """
+    def __init__(
+            self,
+            urls: list[str],
+            hedge_percentile: float = 0.9,
+            min_hedge_delay: float = 0.05,
+            default_hedge_delay: float = 0.5,
+            max_hedge_delay: float = 2.0,
+            hedge_median_factor: float = 3.0,
+            max_hedges: int = 1,
+            failure_threshold: int = 5,
+            open_seconds: float = 30,
+            probe_interval: float = 5,
+            clock=time.monotonic,
+    ):
+        if len(urls) == 0:
+            raise ValueError("RpcPool needs at least one endpoint")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.hedge_median_factor = hedge_median_factor
+        self.max_hedges = max_hedges
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self._probe_task = None
+
+    def is_open(self, endpoint: Endpoint):
+        return endpoint.open_until > self.clock()
+
+    def score(self, endpoint: Endpoint):
+        slots = [e.slot for e in self.endpoints if e.slot is not None]
+        lag = max(slots) - endpoint.slot if endpoint.slot is not None and slots else 0
+        return endpoint.latency(0.5, self.default_hedge_delay) \
+            + endpoint.error_rate * ERROR_PENALTY \
+            + lag * SLOT_LAG_PENALTY
+
+    def ranked(self):
+        """ closed endpoints best first, or all of them if every circuit is open """
+        closed = [e for e in self.endpoints if not self.is_open(e)]
+        return sorted(closed or self.endpoints, key=self.score)
+
+    def hedge_delay(self, endpoint: Endpoint):
+        # the sample includes the slow answers hedging cuts: once they reach
+        # the percentile it would track them, the median stays put
+        delay = min(
+            endpoint.latency(self.hedge_percentile, self.default_hedge_delay),
+            endpoint.latency(0.5, self.default_hedge_delay) * self.hedge_median_factor,
+            self.max_hedge_delay,
+        )
+        return max(self.min_hedge_delay, delay)
+
+    def _record_success(self, endpoint: Endpoint, latency: float):
+        endpoint.latencies.append(latency)
+        endpoint.error_rate *= 1 - ERROR_ALPHA
+        endpoint.failures = 0
+        endpoint.open_until = 0.0
+
+    def _record_unavailable(self, endpoint: Endpoint, latency: float):
+        # the endpoint works but lacks data: worse score, circuit untouched
+        endpoint.latencies.append(latency)
+        endpoint.error_rate = endpoint.error_rate * (1 - ERROR_ALPHA) + ERROR_ALPHA
+        endpoint.failures = 0
+
+    def _record_failure(self, endpoint: Endpoint):
+        endpoint.error_rate = endpoint.error_rate * (1 - ERROR_ALPHA) + ERROR_ALPHA
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            endpoint.open_until = self.clock() + self.open_seconds
+            logging.error(f"RPC endpoint {endpoint.url} ejected for {self.open_seconds}s after {endpoint.failures} failures")
+
+    async def _attempt(self, endpoint: Endpoint, request):
+        start = self.clock()
+        try:
+            response = await request(endpoint.url)
+        except RpcError as e:
+            # the endpoint answered, the request itself failed
+            if is_unavailable(e):
+                self._record_unavailable(endpoint, self.clock() - start)
+            else:
+                self._record_success(endpoint, self.clock() - start)
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._record_failure(endpoint)
+            raise
+        if has_unavailable(response):
+            self._record_unavailable(endpoint, self.clock() - start)
+        else:
+            self._record_success(endpoint, self.clock() - start)
+        return response
+
+    async def _hedged(self, request):
+        self._ensure_probe()
+        candidates = self.ranked()
+        pending = set()
+        errors = []
+        launched = []
+        hedges = 0
+        unavailable = None
+
+        def launch():
+            endpoint = candidates[len(launched)]
+            launched.append(endpoint)
+            pending.add(asyncio.create_task(self._attempt(endpoint, request)))
+
+        launch()
+        try:
+            while len(pending) > 0:
+                can_hedge = hedges < self.max_hedges and len(launched) < len(candidates)
+                timeout = self.hedge_delay(launched[-1]) if can_hedge else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        if not has_unavailable(task.result()):
+                            return task.result()
+                        unavailable = task
+                    elif is_unavailable(error):
+                        unavailable = task
+                    elif isinstance(error, RpcError):
+                        raise error
+                    else:
+                        errors.append(error)
+                # transport failure or missing data: fail over right away
+                if len(launched) < len(candidates):
+                    launch()
+            # no endpoint had the data, that is the answer
+            if unavailable is not None:
+                return unavailable.result()
+            raise errors[-1]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, method: str, params: any) -> dict:
+        return await self._hedged(lambda url: call_rpc_method(url, method, params))
+
+    async def call_batch(self, calls: list[tuple[str, any]]) -> list[dict]:
+        return await self._hedged(lambda url: call_rpc_batch(url, calls))
+
+    def _ensure_probe(self):
+        if len(self.endpoints) > 1 and (self._probe_task is None or self._probe_task.done()):
+            self._probe_task = asyncio.create_task(self._probe())
+
+    async def _probe_endpoint(self, endpoint: Endpoint):
+        try:
+            response = await self._attempt(
+                endpoint,
+                lambda url: call_rpc_method(url, "getSlot", [{"commitment": "finalized"}])
+            )
+            endpoint.slot = response["result"]
+        except Exception:
+            pass
+
+    async def _probe(self):
+        """ refreshes slot lag and gives ejected endpoints a chance to recover """
+        while True:
+            await asyncio.gather(*[self._probe_endpoint(e) for e in self.endpoints])
+            await asyncio.sleep(self.probe_interval)
@@ -0,0 +1,40 @@
+from solders.pubkey import Pubkey
+
+
+# Deposit address derivation, run in the pda worker processes. Keep the
+# imports to solders: anything under custody_service.chain_utils would pull
+# in the observer and the database in every worker.
+PDA_MODULE = __name__
+
+
+def derive_deposit_address(program_id: str, agent: str, account: int, index: int) -> tuple[str, int]:
+    program_id = Pubkey.from_string(program_id)
+
+    # Convert prefix seed (UTF-8 string) to bytes
+    prefix_bytes = "user-vault".encode('utf-8')
+
+    # Convert agent (u256 hex string) to bytes
+    agent_bytes = bytes.fromhex(agent[2:])  # Skip the '0x' prefix
+    if len(agent_bytes) > 32:
+        raise ValueError(
+            "agentId hex string is too long to fit into 32 bytes.")
+    elif len(agent_bytes) < 32:
+        agent_bytes = agent_bytes.rjust(32, b'\x00')
+
+    # Convert account and index to bytes (int to 8-byte representation)
+    account_bytes = account.to_bytes(8, 'big')
+    index_bytes = index.to_bytes(8, 'big')
+
+    # Combine all the seed data into one list
+    seeds = [prefix_bytes, agent_bytes, account_bytes, index_bytes]
+    # for b in seeds:
+    #     print("-".join([f"{byte:02x}" for byte in b]))
+
+    # Derive the PDA using the seeds and program ID
+    (deposit_address, bump) = Pubkey.find_program_address(seeds, program_id)
+
+    return str(deposit_address), bump
+
+
+def derive_chunk(program_id: str, agent: str, account: int, users: list[int]):
+    return {user: derive_deposit_address(program_id, agent, account, user) for user in users}
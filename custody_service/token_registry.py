@@ -0,0 +1,67 @@
+from .custom_types import AvailableTokenInfo
+import json, logging, os, threading, time
+
+
+TOKENS_FILE = os.path.join(os.path.dirname(__file__), "./data/available-tokens.json")
+
+
+class TokenRegistry:
+    """
+    The available tokens file, parsed once and indexed by (chain, symbol)
+    and (chain, contract). The file mtime is checked at most every
+    `check_interval` seconds and the registry reloads when it changed.
+    """
+    def __init__(self, path: str = TOKENS_FILE, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0
+        # replaced as a whole on reload, so readers never see a partial state
+        self._data = ({}, {}, {})
+        self._reload_if_changed()
+
+    def _reload_if_changed(self):
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path, 'r') as file:
+                    tokens = json.load(file)
+            except ValueError as e:
+                # keep serving the previous tokens while the file is being rewritten
+                logging.error(f"Invalid tokens file {self.path}: {e}")
+                return
+            by_symbol = {}
+            by_contract = {}
+            for chain, chain_tokens in tokens.items():
+                for token in chain_tokens:
+                    by_symbol[(chain, token["symbol"])] = token
+                    if token.get("contract") is not None:
+                        by_contract[(chain, token["contract"])] = token
+            self._data = (tokens, by_symbol, by_contract)
+            self._mtime = mtime
+
+    def _current(self):
+        if time.monotonic() >= self._next_check:
+            self._reload_if_changed()
+        return self._data
+
+    def get_tokens(self, chain: str=None):
+        tokens, _, _ = self._current()
+        if chain is not None:
+            return tokens.get(chain, [])
+        return tokens
+
+    def find_by_symbol(self, chain: str, symbol: str) -> AvailableTokenInfo:
+        _, by_symbol, _ = self._current()
+        return by_symbol.get((chain, symbol))
+
+    def find_by_contract(self, chain: str, contract: str) -> AvailableTokenInfo:
+        _, _, by_contract = self._current()
+        return by_contract.get((chain, contract))
+
+
+token_registry = TokenRegistry()
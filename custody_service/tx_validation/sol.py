@@ -9,49 +9,83 @@ import json
 
 MIN_DEPOSIT_AMOUNT = 0.0001 * 1000_0000_1000
 
+SYSTEM_PROGRAM = "11111111111111111111111111111111"
+# SystemInstruction::Transfer index, followed by the u64 lamports
+SYSTEM_TRANSFER = 2
+
+
+def get_system_transfers(tx_data):
+    """ yields (destination, lamports) of the SOL transfer instructions of a json encoded tx """
+    message = tx_data["transaction"]["message"]
+    # instructions index the static account keys, then the loaded ones (v0 txs)
+    accounts = message["accountKeys"]
+    loaded_addresses = tx_data["meta"].get("loadedAddresses")
+    if loaded_addresses:
+        accounts = accounts + loaded_addresses["writable"] + loaded_addresses["readonly"]
+
+    for instruction in message["instructions"]:
+        if accounts[instruction["programIdIndex"]] != SYSTEM_PROGRAM:
+            continue
+        data = solana_chain_utils.b58decode(instruction["data"])
+        if len(data) != 12 or int.from_bytes(data[:4], "little") != SYSTEM_TRANSFER:
+            continue
+        yield accounts[instruction["accounts"][1]], int.from_bytes(data[4:], "little")
+
+
+def check_deposit(deposit: ZellularDepositTx, tx_data) -> Optional[ZellularDepositTx]:
+    if not tx_data:
+        print("tx not found")
+        return None
+
+    # Extract transaction meta and instructions
+    meta = tx_data.get("meta", {})
+    if not meta:
+        print("no meta")
+        return None
+
+    # Look for SOL transfer instruction
+    for destination, lamports in get_system_transfers(tx_data):
+        if destination == deposit["address"] and lamports >= MIN_DEPOSIT_AMOUNT:
+            return ZellularDepositTx(
+                chain="SOL",
+                block=tx_data["slot"],
+                txHash=tx_data["transaction"]["signatures"][0],
+                agent="Unknown",  # Adjust based on your context
+                account=0,  # Adjust based on your context
+                user=0,  # Adjust based on your context
+                address=destination,
+                deposit=ZellularDepositeToken(
+                    token="SOL",
+                    amount=lamports,
+                    decimals=9
+                )
+            )
+    return None
+
 
 async def validate_deposit(deposit: ZellularDepositTx) -> Optional[ZellularDepositTx]:
     try:
-        # print("fetching tx ...", deposit)
-        tx_data = await solana_chain_utils.get_transaction(deposit["txHash"], "jsonParsed")
-        # print("tx: ", tx_data)
-        # Extract transaction meta and instructions
-        meta = tx_data.get("meta", {})
-        if not meta:
-            print("no meta")
-            return None
-
-        # Look for SOL transfer instruction
-        for instruction in tx_data["transaction"]["message"]["instructions"]:
-            program_id = instruction.get("programId")
-            print("programm_id: ", program_id);
-            if program_id == "11111111111111111111111111111111":  # System Program
-                parsed = instruction.get("parsed", {})
-                if parsed.get("type") == "transfer":
-                    info = parsed.get("info", {})
-                    if (
-                            info.get("destination") == deposit["address"] and
-                            int(info.get("lamports", 0)) >= MIN_DEPOSIT_AMOUNT
-                    ):
-                        return ZellularDepositTx(
-                            chain="SOL",
-                            block=tx_data["slot"],
-                            txHash=tx_data["transaction"]["signatures"][0],
-                            agent="Unknown",  # Adjust based on your context
-                            account=0,  # Adjust based on your context
-                            user=0,  # Adjust based on your context
-                            address=info["destination"],
-                            deposit=ZellularDepositeToken(
-                                token="SOL",
-                                amount=int(info["lamports"]),
-                                decimals=9
-                            )
-                        )
-        return None
+        tx_data, = await solana_chain_utils.get_cached_transactions([deposit["txHash"]])
+        return check_deposit(deposit, tx_data)
     except Exception as e:
         print(f"Error validating transaction: {e}")
         return None
 
 
+async def validate_deposits(deposits: list[ZellularDepositTx]) -> list[Optional[ZellularDepositTx]]:
+    """Validates deposits with batched transaction fetches, results in input order."""
+    tx_hashes = [d["txHash"] for d in deposits]
+    txs = await solana_chain_utils.get_cached_transactions(tx_hashes)
+
+    results = []
+    for deposit, tx_data in zip(deposits, txs):
+        try:
+            results.append(check_deposit(deposit, tx_data))
+        except Exception as e:
+            print(f"Error validating transaction {deposit['txHash']}: {e}")
+            results.append(None)
+    return results
+
+
 async def get_last_confirmed_block():
     return await solana_chain_utils.get_slot()
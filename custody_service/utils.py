@@ -1,23 +1,63 @@
-import httpx, json, os
-from .zellular import Zellular
+import httpx, json, os, asyncio, hashlib
+from .zellular import Zellular, AsyncZellular
 
 
 
 zellular = Zellular("custody_service_app", "http://localhost:6379")
+async_zellular = AsyncZellular("custody_service_app", "http://localhost:6379")
 
 
 def get_zellular():
     return zellular;
 
 
-def register_deposits(deposits):
-    zellular = get_zellular()
-    return zellular.send([{
+def get_async_zellular():
+    return async_zellular;
+
+
+async def register_deposits(deposits):
+    zellular = get_async_zellular()
+    return await zellular.send([{
         "type": "Deposit", 
         "data": deposits
     }])
 
 
+# shared connection pools for the json-rpc calls, one per (event loop,
+# endpoint) so every endpoint gets its own connection limits
+RPC_TIMEOUT = httpx.Timeout(float(os.getenv("RPC_TIMEOUT", "30")), connect=5.0)
+RPC_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("RPC_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("RPC_MAX_KEEPALIVE_CONNECTIONS", "20")),
+    keepalive_expiry=30,
+)
+# needs the h2 package (httpx[http2])
+RPC_HTTP2 = os.getenv("RPC_HTTP2") == "1"
+
+rpc_clients: dict[tuple, httpx.AsyncClient] = {}
+
+
+def get_rpc_client(endpoint: str) -> httpx.AsyncClient:
+    key = (asyncio.get_running_loop(), endpoint)
+    client = rpc_clients.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=RPC_TIMEOUT,
+            limits=RPC_LIMITS,
+            http2=RPC_HTTP2,
+            headers={"Content-Type": "application/json"},
+        )
+        rpc_clients[key] = client
+    return client
+
+
+class RpcError(Exception):
+    def __init__(self, error):
+        super().__init__(f"RPC Error: {error}")
+        self.error = error
+        self.code = error.get("code") if isinstance(error, dict) else None
+
+
 async def call_rpc_method(endpoint: str, method: str, params: any, id: int = 1) -> dict:
     payload = json.dumps({
         "jsonrpc": "2.0",
@@ -25,20 +65,50 @@ async def call_rpc_method(endpoint: str, method: str, params: any, id: int = 1)
         "method": method,
         "params": params
     })
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            endpoint,
-            headers={"Content-Type": "application/json"},
-            content=payload
-        )
-        response.raise_for_status()  # Raise an error for HTTP status codes >= 400
-        result = response.json()
-        if "error" in result:
-            raise Exception(f"RPC Error: {result['error']}")
-        return result
+    client = get_rpc_client(endpoint)
+    response = await client.post(endpoint, content=payload)
+    response.raise_for_status()  # Raise an error for HTTP status codes >= 400
+    result = response.json()
+    if "error" in result:
+        raise RpcError(result['error'])
+    return result
+
+
+async def call_rpc_batch(endpoint: str, calls: list[tuple[str, any]]) -> list[dict]:
+    """
+    Sends many (method, params) calls as one JSON-RPC batch request and
+    returns their responses in call order. Failed calls keep their "error"
+    member; checking it is up to the caller.
+    """
+    if len(calls) == 0:
+        return []
+    payload = json.dumps([
+        {"jsonrpc": "2.0", "id": id, "method": method, "params": params}
+        for id, (method, params) in enumerate(calls)
+    ])
+    client = get_rpc_client(endpoint)
+    response = await client.post(endpoint, content=payload)
+    response.raise_for_status()
+    result = response.json()
+    if not isinstance(result, list):
+        # the whole batch was rejected
+        raise RpcError(result.get("error", result))
+    responses = {r.get("id"): r for r in result}
+    return [
+        responses.get(id, {"id": id, "error": {"code": None, "message": "missing from batch response"}})
+        for id in range(len(calls))
+    ]
+
     
 def get_env_or_error(name):
     value = os.getenv(name)
     if value is None:
         raise EnvironmentError(f"Missing required environment variable: {name}")
-    return value
\ No newline at end of file
+    return value
+
+
+def generate_agent_id(signers: list[str], sequence_id: str):
+    data = b''.join(bytes.fromhex(hex_str[2:]) for hex_str in signers)
+    data += sequence_id.encode('utf-8')
+    hash_object = hashlib.sha256(data)
+    return "0x" + hash_object.hexdigest()
@@ -1,39 +1,188 @@
-import redis, json, asyncio, urllib, time
+import redis, redis.asyncio, json, asyncio, urllib, time, uuid
+
+
+# pushes a batch, records its id -> index and notifies consumers atomically.
+# RPUSH returns the new list length, which is the index batches() yields.
+SEND_SCRIPT = """
+local index = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], index, 'EX', ARGV[2])
+if ARGV[3] == '1' then
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', 1000, '*', 'index', index)
+end
+return index
+"""
 
 class Zellular:
-    def __init__(self, app_name, base_url, threshold_percent=67):
+    def __init__(self, app_name, base_url, threshold_percent=67, notify=True, block_ms=1000, id_ttl=86400):
         self.app_name = app_name
         self.base_url = base_url
         self.threshold_percent = threshold_percent
+        # when enabled, send() also appends to a companion stream that
+        # consumers block on instead of polling the batches list
+        self.notify = notify
+        self.block_ms = block_ms
+        self.notify_key = f"{app_name}:notify"
+        # seconds a batch id -> index mapping is kept around
+        self.id_ttl = id_ttl
         url = urllib.parse.urlparse(base_url)
         self.r = redis.Redis(host=url.hostname, port=url.port, db=0)
+        self._send_script = self.r.register_script(SEND_SCRIPT)
+
+    def _id_key(self, batch_id):
+        return f"{self.app_name}:batch:{batch_id}"
+
+    def _last_notification(self):
+        last = self.r.xrevrange(self.notify_key, count=1)
+        return last[0][0] if last else "0-0"
+
+    def _wait_notification(self, last_id):
+        # writers that do not notify (notify=False) are still picked up by
+        # the range read that follows the block timeout
+        result = self.r.xread({self.notify_key: last_id}, count=100, block=self.block_ms)
+        if not result:
+            return last_id
+        _, entries = result[0]
+        return entries[-1][0]
 
     def batches(self, after=0):
         assert after >= 0, "after should be equal or bigger than 0"
+        if self.notify:
+            # read before the range so a batch pushed in between wakes us up
+            last_id = self._last_notification()
         while True:
             batches = self.r.lrange(self.app_name, after, after + 100)
             for batch in batches:
                 print(batch)
                 after += 1
                 yield batch, after
-            time.sleep(0.1)
+            if len(batches) > 100:
+                continue
+            if self.notify:
+                last_id = self._wait_notification(last_id)
+            else:
+                time.sleep(0.1)
 
     def get_last_finalized(self):
         return { "index": self.r.llen(self.app_name) }
 
-    def send(self, batch, blocking=False):
-        if blocking:
-            index = self.get_last_finalized()["index"]
+    def get_batch_index(self, batch_id):
+        index = self.r.get(self._id_key(batch_id))
+        return int(index) if index is not None else None
 
-        self.r.rpush(self.app_name, json.dumps(batch))
+    def _status_key(self, batch_id):
+        return f"{self.app_name}:submission:{batch_id}"
 
-        if not blocking:
-            return
+    def set_submission_status(self, batch_id, status: dict, only_new=False):
+        """
+        Records the state of a batch that is not pushed yet (e.g. queued or
+        failed in a group commit), kept as long as batch id mappings.
+        """
+        self.r.set(self._status_key(batch_id), json.dumps(status), ex=self.id_ttl, nx=only_new)
+
+    def get_submission_status(self, batch_id):
+        status = self.r.get(self._status_key(batch_id))
+        return json.loads(status) if status is not None else None
 
-        for received_batch, index in self.batches(after=index):
-            received_batch = json.loads(received_batch)
-            if batch == received_batch:
+    def wait_batch_index(self, batch_id, timeout):
+        """ get_batch_index() that waits up to timeout seconds for the batch """
+        deadline = time.monotonic() + timeout
+        last_id = self._last_notification() if self.notify else None
+        while True:
+            index = self.get_batch_index(batch_id)
+            remaining = deadline - time.monotonic()
+            if index is not None or remaining <= 0:
                 return index
+            if self.notify:
+                result = self.r.xread({self.notify_key: last_id}, count=100, block=max(1, int(remaining * 1000)))
+                if result:
+                    last_id = result[0][1][-1][0]
+            else:
+                time.sleep(min(0.1, remaining))
+
+    def send(self, batch, blocking=False, batch_id=None):
+        """
+        Pushes the batch under the given or a fresh batch id. Returns its
+        index when blocking, otherwise the batch id, which get_batch_index()
+        resolves.
+        """
+        batch_id = batch_id or uuid.uuid4().hex
+        index = self._send_script(
+            keys=[self.app_name, self._id_key(batch_id), self.notify_key],
+            args=[json.dumps(batch), self.id_ttl, "1" if self.notify else "0"],
+        )
+
+        if not blocking:
+            return batch_id
+
+        return int(index)
+
+
+
+class AsyncZellular:
+    """
+    asyncio counterpart of Zellular with the same semantics, for the async
+    workers. Waiting for batches or for a send never blocks the event loop.
+    """
+    def __init__(self, app_name, base_url, threshold_percent=67, notify=True, block_ms=1000, id_ttl=86400):
+        self.app_name = app_name
+        self.base_url = base_url
+        self.threshold_percent = threshold_percent
+        self.notify = notify
+        self.block_ms = block_ms
+        self.notify_key = f"{app_name}:notify"
+        self.id_ttl = id_ttl
+        url = urllib.parse.urlparse(base_url)
+        self.r = redis.asyncio.Redis(host=url.hostname, port=url.port, db=0)
+        self._send_script = self.r.register_script(SEND_SCRIPT)
+
+    def _id_key(self, batch_id):
+        return f"{self.app_name}:batch:{batch_id}"
+
+    async def _last_notification(self):
+        last = await self.r.xrevrange(self.notify_key, count=1)
+        return last[0][0] if last else "0-0"
+
+    async def _wait_notification(self, last_id):
+        result = await self.r.xread({self.notify_key: last_id}, count=100, block=self.block_ms)
+        if not result:
+            return last_id
+        _, entries = result[0]
+        return entries[-1][0]
+
+    async def batches(self, after=0):
+        assert after >= 0, "after should be equal or bigger than 0"
+        if self.notify:
+            last_id = await self._last_notification()
+        while True:
+            batches = await self.r.lrange(self.app_name, after, after + 100)
+            for batch in batches:
+                after += 1
+                yield batch, after
+            if len(batches) > 100:
+                continue
+            if self.notify:
+                last_id = await self._wait_notification(last_id)
+            else:
+                await asyncio.sleep(0.1)
+
+    async def get_last_finalized(self):
+        return { "index": await self.r.llen(self.app_name) }
+
+    async def get_batch_index(self, batch_id):
+        index = await self.r.get(self._id_key(batch_id))
+        return int(index) if index is not None else None
+
+    async def send(self, batch, blocking=False, batch_id=None):
+        batch_id = batch_id or uuid.uuid4().hex
+        index = await self._send_script(
+            keys=[self.app_name, self._id_key(batch_id), self.notify_key],
+            args=[json.dumps(batch), self.id_ttl, "1" if self.notify else "0"],
+        )
+
+        if not blocking:
+            return batch_id
+
+        return int(index)
 
 
 if __name__ == "__main__":
@@ -2,28 +2,202 @@ from custody_service.configs import get_zellular
 from custody_service.custom_types import ZellularDepositTx, ChainId
 from custody_service.tx_validation import all_validators
 from custody_service import database
+from pymongo.errors import OperationFailure
 import asyncio
+import heapq
+import os
 import sys
 
 
+# deposits per validation batch (one JSON-RPC batch of tx fetches)
+VALIDATION_BATCH_SIZE = int(os.getenv("DEPOSIT_VALIDATION_BATCH_SIZE", "100"))
+# batches validated at the same time
+VALIDATION_CONCURRENCY = int(os.getenv("DEPOSIT_VALIDATION_CONCURRENCY", "8"))
+# watch mode: finalized slot polling while deposits wait for finality
+FINALIZED_POLL_INTERVAL = float(os.getenv("DEPOSIT_FINALIZED_POLL_INTERVAL", "1"))
+# watch mode: seconds before a deposit that failed validation is retried
+VALIDATION_RETRY_INTERVAL = float(os.getenv("DEPOSIT_VALIDATION_RETRY_INTERVAL", "30"))
+# watch mode: change stream events between resume token saves
+RESUME_TOKEN_SAVE_EVERY = 100
+
+
+async def validate_batch(validator, deposits, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        results = await validator.validate_deposits(deposits)
+    confirmed = []
+    for d, validated in zip(deposits, results):
+        if validated:
+            confirmed.append(d["txHash"])
+        else:
+            print("not validated: ", d["txHash"])
+    return confirmed
+
+
 async def confirm_deposits(chainId):
     print("start confirming deposits ...")
     validator = all_validators[chainId]
+    chain = ChainId(chainId)
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
     while (True):
         try:
-            deposits = database.get_unconfirmed(ChainId.Solana)
             last_confirmed_block = await validator.get_last_confirmed_block()
-
             print("last confirmed block: ", last_confirmed_block)
-            for d in deposits:
-                if d["block"] <= last_confirmed_block:
-                    print("validating: ", d)
-                    validated = await validator.validate_deposit(d)
-                    if validated:
-                        database.update_deposit({"txHash": d["txHash"]}, {
-                                                "$set": {"confirmed": True}})
-                    else:
-                        print("not validated")
+
+            deposits = list(database.get_unconfirmed(chain, last_confirmed_block))
+            batches = [
+                deposits[i:i + VALIDATION_BATCH_SIZE]
+                for i in range(0, len(deposits), VALIDATION_BATCH_SIZE)
+            ]
+            results = await asyncio.gather(*[validate_batch(validator, batch, semaphore) for batch in batches])
+
+            confirmed = [tx_hash for batch in results for tx_hash in batch]
+            if confirmed:
+                database.confirm_deposits(confirmed)
+            if deposits:
+                print(f"confirmed {len(confirmed)} of {len(deposits)} deposits")
+        except Exception as e:
+            print("An error uccured: ", e)
+        await asyncio.sleep(5)
+
+
+class PendingDeposits:
+    """Unconfirmed deposits of the watch mode, ordered by slot."""
+
+    def __init__(self):
+        self.heap = []
+        self.deposits = {}
+        self.added = asyncio.Event()
+
+    def __len__(self):
+        return len(self.deposits)
+
+    def add(self, deposit):
+        # the startup scan and a resumed stream may both report a deposit
+        if deposit["txHash"] in self.deposits:
+            return
+        # the schema does not require a block, the polling mode never selects
+        # such deposits either
+        if not isinstance(deposit.get("block"), int):
+            print("skipped deposit without a block: ", deposit["txHash"])
+            return
+        self.deposits[deposit["txHash"]] = deposit
+        self.requeue(deposit)
+
+    def requeue(self, deposit):
+        heapq.heappush(self.heap, (deposit["block"], deposit["txHash"]))
+        self.added.set()
+
+    def pop_ready(self, last_confirmed_block: int):
+        ready = []
+        while self.heap and self.heap[0][0] <= last_confirmed_block:
+            _, tx_hash = heapq.heappop(self.heap)
+            ready.append(self.deposits[tx_hash])
+        return ready
+
+    def remove(self, tx_hashes: list[str]):
+        for tx_hash in tx_hashes:
+            self.deposits.pop(tx_hash, None)
+
+
+def open_deposits_stream(chain: ChainId, token_id: str):
+    resume_token = database.get_resume_token(token_id)
+    if resume_token is not None:
+        try:
+            return database.watch_deposits(chain, resume_token)
+        except OperationFailure as e:
+            # the token is no longer in the oplog, the startup scan covers the gap
+            print("cannot resume the deposits change stream: ", e)
+    return database.watch_deposits(chain)
+
+
+async def follow_deposits(stream, token_id: str, pending: PendingDeposits):
+    saved_token = None
+    unsaved = 0
+    while True:
+        change = await asyncio.to_thread(stream.try_next)
+        if change is not None:
+            pending.add(change["fullDocument"])
+            unsaved += 1
+        # save the token once the stream is drained, or every few events under load
+        token = stream.resume_token
+        if token is not None and token != saved_token and (change is None or unsaved >= RESUME_TOKEN_SAVE_EVERY):
+            database.set_resume_token(token_id, token)
+            saved_token = token
+            unsaved = 0
+
+
+async def confirm_pending(validator, pending: PendingDeposits, semaphore: asyncio.Semaphore):
+    loop = asyncio.get_running_loop()
+    while True:
+        if not pending.heap:
+            await pending.added.wait()
+        pending.added.clear()
+
+        ready = []
+        confirmed = []
+        try:
+            last_confirmed_block = await validator.get_last_confirmed_block()
+            ready = pending.pop_ready(last_confirmed_block)
+            batches = [
+                ready[i:i + VALIDATION_BATCH_SIZE]
+                for i in range(0, len(ready), VALIDATION_BATCH_SIZE)
+            ]
+            results = await asyncio.gather(*[validate_batch(validator, batch, semaphore) for batch in batches])
+            confirmed = [tx_hash for batch in results for tx_hash in batch]
+            if confirmed:
+                database.confirm_deposits(confirmed)
+        except Exception as e:
+            print("An error uccured: ", e)
+            confirmed = []
+        if ready:
+            pending.remove(confirmed)
+            confirmed = set(confirmed)
+            for d in ready:
+                if d["txHash"] not in confirmed:
+                    loop.call_later(VALIDATION_RETRY_INTERVAL, pending.requeue, d)
+            print(f"confirmed {len(confirmed)} of {len(ready)} deposits, {len(pending)} pending")
+
+        # wake up on new deposits, or when the finalized slot may have moved on
+        if pending.heap and not pending.added.is_set():
+            try:
+                await asyncio.wait_for(pending.added.wait(), FINALIZED_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def watch_deposits(chainId):
+    """
+    confirm_deposits() driven by a change stream on the deposits collection
+    instead of polling it. Needs a replica set.
+    """
+    print("start watching deposits ...")
+    validator = all_validators[chainId]
+    chain = ChainId(chainId)
+    token_id = f"deposit_validator:{chainId}"
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    while (True):
+        try:
+            pending = PendingDeposits()
+            # open the stream before the scan so no insert falls in between
+            with open_deposits_stream(chain, token_id) as stream:
+                # the queue does not survive restarts, reload it
+                for d in database.get_unconfirmed(chain):
+                    pending.add(d)
+                print(f"{len(pending)} unconfirmed deposits")
+                tasks = [
+                    asyncio.create_task(follow_deposits(stream, token_id, pending)),
+                    asyncio.create_task(confirm_pending(validator, pending, semaphore)),
+                ]
+                try:
+                    # both run forever, so one finishing means it failed
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                    for task in done:
+                        task.result()
+                finally:
+                    # never leave the sibling running on a closed stream or a stale queue
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
         except Exception as e:
             print("An error uccured: ", e)
         await asyncio.sleep(5)
@@ -31,8 +205,9 @@ async def confirm_deposits(chainId):
 
 if __name__ == "__main__":
     chainId = sys.argv[1]
-    valid_chain_ids = [chain.value for chain in ChainId]
-    if not chainId in valid_chain_ids:
-        raise Exception(f"Incorrect chainId: {
-                        chainId}. correct: {valid_chain_ids}")
-    asyncio.run(confirm_deposits(chainId))
+    if not chainId in all_validators:
+        raise Exception(f"Incorrect chainId: {chainId}. correct: {list(all_validators)}")
+    if len(sys.argv) > 2 and sys.argv[2] == "watch":
+        asyncio.run(watch_deposits(chainId))
+    else:
+        asyncio.run(confirm_deposits(chainId))
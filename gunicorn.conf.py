@@ -0,0 +1,28 @@
+# Production serving of node.py:
+#   gunicorn -c gunicorn.conf.py "node:create_app()"
+from custody_service.configs import generate_privates_and_nodes_info, num_to_hex
+import os
+
+
+_, nodes_info = generate_privates_and_nodes_info()
+node_info = nodes_info[num_to_hex(int(os.getenv("NODE_ID")))]
+
+bind = f"0.0.0.0:{node_info['port']}"
+
+# each worker process serves requests on a pool of threads
+worker_class = "gthread"
+workers = int(os.getenv("NODE_WORKERS", "4"))
+threads = int(os.getenv("NODE_THREADS", "8"))
+
+keepalive = int(os.getenv("NODE_KEEPALIVE", "5"))
+# workers silent for longer than this are killed and restarted
+timeout = int(os.getenv("NODE_TIMEOUT", "60"))
+# on SIGTERM, in-flight requests get this long to finish
+graceful_timeout = int(os.getenv("NODE_GRACEFUL_TIMEOUT", "30"))
+
+# the app is loaded in every worker after the fork, so each one opens its
+# own mongo and redis connections
+preload_app = False
+
+accesslog = os.getenv("NODE_ACCESS_LOG")
+loglevel = os.getenv("NODE_LOG_LEVEL", "info")
@@ -1,7 +1,19 @@
 import * as redis from 'redis';
 import * as url from 'url';
+import { randomUUID } from 'crypto';
 import { timeout } from './utils';
 
+// same script as custody_service/zellular.py: push the batch, map its id to
+// its index and notify the consumers blocked on the companion stream
+const SEND_SCRIPT = `
+local index = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], index, 'EX', ARGV[2])
+if ARGV[3] == '1' then
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', 1000, '*', 'index', index)
+end
+return index
+`;
+
 type ZellularBatchTx  = {
     type: "AgentRegister" | "CreateDepositAddress" | "Deposit" | "AddWithdraw" | "ApproveWithdraw" | "TransferWithdraw",
     data: any
@@ -11,12 +23,16 @@ export class Zellular {
 	private appName: string;
 	private baseUrl: string;
 	private thresholdPercent: number;
+	private notify: boolean;
+	private idTtl: number;
 	private r: redis.RedisClientType;
 
-	constructor(appName: string, baseUrl: string, thresholdPercent: number = 67) {
+	constructor(appName: string, baseUrl: string, thresholdPercent: number = 67, notify: boolean = true, idTtl: number = 86400) {
 		this.appName = appName;
 		this.baseUrl = baseUrl;
 		this.thresholdPercent = thresholdPercent;
+		this.notify = notify;
+		this.idTtl = idTtl;
 
 		const parsedUrl = url.parse(baseUrl);
 		this.r = redis.createClient({
@@ -44,25 +60,18 @@ export class Zellular {
 		return { index: length };
 	}
 
-	async send(batch: ZellularBatchTx[], blocking: boolean = false) {
-		let index;
-		if (blocking) {
-			index = await this.getLastFinalized();
-		}
-
-		await this.r.rPush(this.appName, JSON.stringify(batch));
+	async send(batch: ZellularBatchTx[], blocking: boolean = false, batchId?: string) {
+		batchId = batchId || randomUUID().replace(/-/g, "");
+		const index = await this.r.eval(SEND_SCRIPT, {
+			keys: [this.appName, `${this.appName}:batch:${batchId}`, `${this.appName}:notify`],
+			arguments: [JSON.stringify(batch), `${this.idTtl}`, this.notify ? "1" : "0"],
+		});
 
 		if (!blocking) {
-			return;
+			return batchId;
 		}
 
-		let receivedBatch;
-		for await ([receivedBatch, index] of this.batches(index)) {
-			const parsedBatch = JSON.parse(receivedBatch);
-			if (batch === parsedBatch) {
-				return index;
-			}
-		}
+		return Number(index);
 	}
 }
 
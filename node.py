@@ -7,7 +7,10 @@ from custody_service.configs import generate_privates_and_nodes_info, num_to_hex
 from custody_service.jsonrpc_handler import JsonRpcHandler
 
 
-def init_logs(file_path: str):
+LOGS_PATH = "node-logs"
+
+
+def init_logs(file_path: str, clear: bool = False):
     node_number = int(os.getenv("NODE_ID"))
     file_name = f"node{node_number}.log"
     log_formatter = logging.Formatter(
@@ -15,9 +18,10 @@ def init_logs(file_path: str):
     )
     root_logger = logging.getLogger()
     if not os.path.exists(file_path):
-        os.mkdir(file_path)
-    with open(f"{file_path}/{file_name}", "w"):
-        pass
+        os.makedirs(file_path, exist_ok=True)
+    if clear:
+        with open(f"{file_path}/{file_name}", "w"):
+            pass
     file_handler = logging.FileHandler(f"{file_path}/{file_name}")
     file_handler.setFormatter(log_formatter)
     root_logger.addHandler(file_handler)
@@ -28,9 +32,12 @@ def init_logs(file_path: str):
     sys.set_int_max_str_digits(0)
 
 
-def run_node() -> None:
-    init_logs("node-logs");
-    print("node ....")
+def create_app(clear_logs: bool = False) -> Flask:
+    """
+    Builds the node app. Also sets up logging, as gunicorn workers only call
+    this. They share the log file, so only the dev server clears it.
+    """
+    init_logs(LOGS_PATH, clear_logs)
     node_number = int(os.getenv("NODE_ID"))
     data_manager = NodeDataManager()
     nodes_info = NodesInfo()
@@ -54,9 +61,17 @@ def run_node() -> None:
     )
     node_info = nodes_info.lookup_node(node_id)
     app = Flask(__name__)
+    app.config["NODE_PORT"] = int(node_info["port"])
     app.register_blueprint(frost_node.blueprint, url_prefix="/pyfrost")
     app.register_blueprint(jsonrpc.blueprint, url_prefix="/jsonrpc")
-    app.run(host="0.0.0.0", port=int(node_info["port"]), debug=True)
+    return app
+
+
+def run_node() -> None:
+    """ development server, see gunicorn.conf.py for production serving """
+    print("node ....")
+    app = create_app(clear_logs=True)
+    app.run(host="0.0.0.0", port=app.config["NODE_PORT"], debug=True)
 
 
 if __name__ == "__main__":
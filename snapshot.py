@@ -0,0 +1,134 @@
+from custody_service import database
+from custody_service.database.migrations import run_migrations, get_version
+import hashlib
+import gzip
+import bson
+import sys
+
+
+# collections rebuilt from the zellular log. dist_keys holds this node's
+# private key shares and is never exported.
+SNAPSHOT_COLLECTIONS = ["agents", "deposit_addresses", "deposits", "withdraws"]
+# version 2 records the database schema version of the exported documents
+SNAPSHOT_VERSION = 2
+SUPPORTED_VERSIONS = [1, 2]
+INSERT_CHUNK = 1000
+
+# Archive layout: a gzip stream of BSON documents. A header with the
+# zellular cursor and the schema version, then for each collection a section
+# marker followed by its documents, then a trailer holding the sha256 of
+# everything before it.
+
+
+def _write_doc(out, hasher, doc):
+    data = bson.encode(doc)
+    hasher.update(data)
+    out.write(data)
+
+
+def _read_doc(file):
+    size_bytes = file.read(4)
+    if len(size_bytes) < 4:
+        raise Exception("Snapshot is truncated")
+    size = int.from_bytes(size_bytes, "little")
+    data = size_bytes + file.read(size - 4)
+    if len(data) < size:
+        raise Exception("Snapshot is truncated")
+    return data, bson.decode(data)
+
+
+def export_snapshot(path: str):
+    # a snapshot read session would outlive minSnapshotHistoryWindowInSeconds
+    # on large databases, so the observer must be stopped instead. the cursor
+    # is checked again at the end to make sure it did not apply anything.
+    cursor = database.get_cursor(database.ZELLULAR_CURSOR_ID)
+    if cursor is None:
+        raise Exception("Nothing applied yet, there is no state to snapshot")
+    index, i = cursor
+
+    hasher = hashlib.sha256()
+    with gzip.open(path, "wb") as out:
+        _write_doc(out, hasher, {"version": SNAPSHOT_VERSION, "schema": get_version(database.db), "index": index, "i": i})
+        for name in SNAPSHOT_COLLECTIONS:
+            collection = database.db[name]
+            _write_doc(out, hasher, {"collection": name})
+            count = 0
+            for doc in collection.find({}).sort("_id", 1):
+                _write_doc(out, hasher, {"doc": doc})
+                count += 1
+            print(f"{name}: {count} documents")
+        out.write(bson.encode({"sha256": hasher.hexdigest()}))
+
+    if database.get_cursor(database.ZELLULAR_CURSOR_ID) != cursor:
+        raise Exception("Zellular observer applied batches during the export, stop it and retry")
+
+    print(f"snapshot at zellular index {index}-{i} written to {path}")
+    return index, i
+
+
+def read_snapshot(path: str):
+    """ yields the snapshot documents once the checksum is verified """
+    hasher = hashlib.sha256()
+    with gzip.open(path, "rb") as file:
+        while True:
+            data, doc = _read_doc(file)
+            if "sha256" in doc:
+                break
+            hasher.update(data)
+    if doc["sha256"] != hasher.hexdigest():
+        raise Exception("Snapshot checksum mismatch")
+
+    with gzip.open(path, "rb") as file:
+        while True:
+            _, doc = _read_doc(file)
+            if "sha256" in doc:
+                return
+            yield doc
+
+
+def import_snapshot(path: str):
+    if database.get_cursor(database.ZELLULAR_CURSOR_ID) is not None:
+        raise Exception("Node already has zellular state, restore only on a fresh node")
+    for name in SNAPSHOT_COLLECTIONS:
+        if database.db[name].estimated_document_count() > 0:
+            raise Exception(f"Collection {name} is not empty, restore only on a fresh node")
+
+    docs = read_snapshot(path)
+    header = next(docs)
+    if header.get("version") not in SUPPORTED_VERSIONS:
+        raise Exception(f"Unsupported snapshot version: {header.get('version')}")
+
+    collection, chunk = None, []
+    for doc in docs:
+        if "collection" in doc:
+            if chunk:
+                collection.insert_many(chunk, ordered=False)
+            collection, chunk = database.db[doc["collection"]], []
+            print(f"restoring {doc['collection']} ...")
+            continue
+        chunk.append(doc["doc"])
+        if len(chunk) >= INSERT_CHUNK:
+            collection.insert_many(chunk, ordered=False)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk, ordered=False)
+
+    # the migrations already ran on connect, before the documents existed.
+    # backfill the ones newer than the archive (all for version 1 archives)
+    run_migrations(database.db, after=header.get("schema", 0))
+
+    # written last so an interrupted restore is not mistaken for a complete one
+    database.set_cursor(database.ZELLULAR_CURSOR_ID, header["index"], header["i"])
+    print(f"snapshot restored, zellular observer resumes after index {header['index']}-{header['i']}")
+    return header["index"], header["i"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ["export", "import"]:
+        raise Exception("Usage: python snapshot.py <export|import> <file>")
+
+    [_, command, path] = sys.argv[:3]
+    if command == "export":
+        export_snapshot(path)
+    else:
+        import_snapshot(path)
@@ -3,7 +3,7 @@ from pyfrost.network.dkg_handler import DkgHandler
 from custody_service.abstracts import NodesInfo
 from custody_service.chain_utils.solana_chain_utils import hash_withdraw
 from custody_service import database
-from custody_service.utils import get_zellular
+from custody_service.utils import get_async_zellular
 from custody_service.custom_types import ZellularTx
 import logging
 import json
@@ -17,7 +17,7 @@ import asyncio
 # TODO: Merge examples with libp2p.
 
 
-zellular = get_zellular()
+zellular = get_async_zellular()
 
 CHAIN_KEY_TYPE = {
     'SOL': 'ed25519',
@@ -142,7 +142,7 @@ async def run_withdraw_executer(chain: str) -> None:
                 logging.info(f"Signature data: {json.dumps(signature, indent=4)}")
                 
             if len(z_txs) > 0:
-                zellular.send(z_txs, blocking=True)
+                await zellular.send(z_txs, blocking=True)
         
         await asyncio.sleep(10)
 
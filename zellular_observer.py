@@ -1,63 +1,166 @@
-from custody_service.configs import get_zellular
+from custody_service.configs import get_async_zellular
 from custody_service.custom_types import ZellularTx, ChainId
 from custody_service.tx_validation import all_validators
+from custody_service.utils import generate_agent_id
 from custody_service import database
+from concurrent.futures import ThreadPoolExecutor
 import json
-import hashlib
 import asyncio
+import os
 
 
-def generate_agent_id(signers: list[str], sequence_id: str):
-    data = b''.join(bytes.fromhex(hex_str[2:]) for hex_str in signers)
-    data += sequence_id.encode('utf-8')
-    hash_object = hashlib.sha256(data)
-    return "0x" + hash_object.hexdigest()
+# id of the apply cursor document in the cursors collection
+CURSOR_ID = database.ZELLULAR_CURSOR_ID
+
+# with more than one worker each batch is split by agent and the agents
+# are applied concurrently
+APPLY_WORKERS = int(os.getenv("ZELLULAR_APPLY_WORKERS", "1"))
+executor = ThreadPoolExecutor(APPLY_WORKERS) if APPLY_WORKERS > 1 else None
+
+
+def tx_ops(index: int, i: int, tx: ZellularTx, withdraw_agents: dict[str, str]):
+    """ returns the (agent, collection, op) triples of the tx """
+    match tx["type"]:
+        case "AgentRegister":
+            agent = tx['data']
+            agent["id"] = generate_agent_id(
+                agent["signers"], f"{index}-{i}")
+            return [(agent["id"], *database.insert_agent_op(agent))]
+        case "CreateDepositAddress":
+            address_data = tx["data"]
+            return [(address_data["agent"], *database.insert_deposit_address_op(address_data))]
+        case "Deposit":
+            return [
+                (d["agent"], *database.insert_deposit_op({**d, "confirmed": False, "transferred": False}))
+                for d in tx["data"]
+            ]
+        case "AddWithdraw":
+            withdraw = tx["data"]
+            return [(withdraw["agent"], *database.insert_new_withdraw_op(withdraw))]
+        case "ApproveWithdraw":
+            id = tx["data"]["id"]
+            verifying_key = tx["data"]["avsVerifyingKey"]
+            signature = tx["data"]["avsSignature"]
+            # TODO: validate signature
+            return [(withdraw_agents.get(id), *database.approve_withdraw_op(id, verifying_key, signature))]
+        case "TransferWithdraw":
+            withdraw_ids = tx["data"]["withdraws"]
+            tx_hash = tx["data"]["txHash"]
+            agent_ids: dict[str, list[str]] = {}
+            for id in withdraw_ids:
+                agent_ids.setdefault(withdraw_agents.get(id), []).append(id)
+            return [
+                (agent, *database.set_withdraws_transfer_tx_op(ids, tx_hash))
+                for agent, ids in agent_ids.items()
+            ]
+        case _:
+            raise Exception(f"Invalid TX type: {tx['type']}")
+
+
+def batch_withdraw_agents(txs: list[ZellularTx], start: int = 0):
+    """
+    Maps the withdraw ids referenced by approve/transfer txs to their agent,
+    from the withdraws added in this batch or else from the database.
+    Withdraws that exist in neither are left out; updating them is a no-op.
+    """
+    agents = {}
+    referenced = set()
+    for tx in txs[start:]:
+        try:
+            match tx["type"]:
+                case "AddWithdraw":
+                    agents[tx["data"]["id"]] = tx["data"]["agent"]
+                case "ApproveWithdraw":
+                    referenced.add(tx["data"]["id"])
+                case "TransferWithdraw":
+                    referenced.update(tx["data"]["withdraws"])
+        except Exception:
+            # malformed txs are reported by batch_ops
+            pass
+    referenced -= agents.keys()
+    if len(referenced) > 0:
+        agents.update(database.get_withdraw_agents(list(referenced)))
+    return agents
+
+
+def batch_ops(index: int, txs: list[ZellularTx], start: int = 0, partitioned: bool = False):
+    """
+    Groups the ops of every tx into per-collection lists, and when
+    partitioned, per agent first. Txs only depend on earlier txs of the same
+    agent touching the same collection, so keeping each list in tx order
+    preserves the outcome of applying them one by one.
+    """
+    withdraw_agents = batch_withdraw_agents(txs, start) if partitioned else {}
+    partitions: dict[str, dict[str, list]] = {}
+    for i in range(start, len(txs)):
+        try:
+            for agent, collection, op in tx_ops(index, i, txs[i], withdraw_agents):
+                ops = partitions.setdefault(agent if partitioned else None, {})
+                ops.setdefault(collection, []).append((i, op))
+        except Exception as e:
+            print(f"Zellular tx {index}-{i} rejected:", str(e))
+    return partitions
+
+
+def write_ops(index: int, ops: dict[str, list], session=None):
+    for collection, entries in ops.items():
+        errors = database.bulk_write(collection, [op for _, op in entries], session)
+        for position, message in errors:
+            print(f"Zellular tx {index}-{entries[position][0]} failed on {collection}:", message)
+
+
+def apply_batch(index: int, txs: list[ZellularTx], start: int = 0):
+    partitions = batch_ops(index, txs, start, partitioned=executor is not None)
+    print(f"applying batch {index}: {len(txs) - start} txs in {len(partitions)} partitions")
+
+    if executor is not None:
+        # a session cannot be shared between threads, so partitions are
+        # written without a transaction and the cursor only moves once all
+        # of them are done. a crash replays the batch, which is a no-op.
+        list(executor.map(lambda ops: write_ops(index, ops), partitions.values()))
+        database.set_cursor(CURSOR_ID, index, len(txs) - 1)
+        return
+
+    ops = partitions.get(None, {})
+
+    # fast path: the whole batch and the cursor are committed together
+    if database.supports_transactions():
+        try:
+            with database.transaction() as session:
+                write_ops(index, ops, session)
+                database.set_cursor(CURSOR_ID, index, len(txs) - 1, session)
+            return
+        except Exception as e:
+            print("Zellular batch handler: transaction aborted, applying ops without it", str(e))
+
+    # slow path: failing ops are reported and skipped. a crash before the
+    # cursor update replays the batch, which the upserts turn into no-ops.
+    write_ops(index, ops)
+    database.set_cursor(CURSOR_ID, index, len(txs) - 1)
 
 
 async def observe_zellular():
     print("start reading zellular txs ...")
-    verifier = get_zellular("custody_service_app")
-    for batch, index in verifier.batches():
+    verifier = get_async_zellular("custody_service_app")
+
+    cursor = database.get_cursor(CURSOR_ID)
+    if cursor is None:
+        after, last_index, last_i = 0, 0, -1
+    else:
+        # re-read the last applied batch in case it was only partially applied
+        last_index, last_i = cursor
+        after = last_index - 1
+    print(f"resuming from batch {after} (last applied: {last_index}-{last_i})")
+
+    async for batch, index in verifier.batches(after=after):
         txs: list[ZellularTx] = json.loads(batch)
-        for i, tx in enumerate(txs):
-            print(index, i, json.dumps(tx, indent=2))
-            try:
-                match tx["type"]:
-                    case "AgentRegister":
-                        agent = tx['data']
-                        agent["id"] = generate_agent_id(
-                            agent["signers"], f"{index}-{i}")
-                        database.insert_agent(agent)
-                    case "CreateDepositAddress":
-                        address_data = tx["data"]
-                        database.insert_deposit_address(address_data)
-                    case "Deposit":
-                        print("inserting deposits into db ...")
-                        for d in tx["data"]:
-                            print("doc to be inserted: ", json.dumps(d, indent=2))
-                            database.insert_deposit({**d, "confirmed": False, "transferred": False})
-                    case "AddWithdraw":
-                        withdraw = tx["data"]
-                        database.insert_new_withdraw(withdraw)
-                    case "ApproveWithdraw":
-                        id = tx["data"]["id"]
-                        verifying_key = tx["data"]["avsVerifyingKey"]
-                        signature = tx["data"]["avsSignature"]
-                        # TODO: validate signature
-                        database.approve_withdraw(id, verifying_key, signature)
-                    case "TransferWithdraw":
-                        withdraw_ids = tx["data"]["withdraws"]
-                        tx_hash = tx["data"]["txHash"]
-                        database.set_withdraws_transfer_tx(withdraw_ids, tx_hash)
-                    case _:
-                        print("Invalid TX")
-                        pass
-            except Exception as e:
-                print("Zellular method handler: An error occurred", str(e))
-                pass
+        start = last_i + 1 if index == last_index else 0
+        if start > 0 and start >= len(txs):
+            continue
+        apply_batch(index, txs, start)
 
 if __name__ == "__main__":
     try:
         asyncio.run(observe_zellular())
     except KeyboardInterrupt:
-        pass
\ No newline at end of file
+        pass